@@ -0,0 +1,122 @@
+import json
+import mmap
+import os
+import struct
+
+from PIL import Image
+
+from config import *
+from io_utils import atomic_write
+from utils import asset_files, get_img
+
+
+# Bump whenever the layout of the atlas file changes, so atlases packed the old way are packed again
+ATLAS_VERSION = 1
+# The header is an 8 byte length followed by that much JSON, and the pixels start at the next multiple of this
+_ALIGNMENT = 4096
+
+
+def _data_start(header_size):
+    return -(-(8 + header_size) // _ALIGNMENT) * _ALIGNMENT
+
+
+def atlas_key(file_path, size, asset_dir=CARD_ASSETS_DIR):
+    # Case folded where the file system is, the same as the asset cache, so a biome asked for as forest.png finds
+    # Forest.PNG on Windows
+    relative_path = os.path.normcase(Path(file_path).relative_to(asset_dir).as_posix())
+    return f'{relative_path}@{size[0]}x{size[1]}'
+
+
+def asset_sources(asset_dir=CARD_ASSETS_DIR):
+    # What the atlas is packed from: every asset, the sizes it's drawn at and the mtime and size of its file
+    sources = {}
+    for file_path, sizes in asset_files(asset_dir):
+        stat = file_path.stat()
+        sources[file_path.relative_to(asset_dir).as_posix()] = [stat.st_mtime_ns, stat.st_size, [list(size) for size in sizes]]
+    return sources
+
+
+class AssetAtlas:
+    # Every asset decoded, resized and packed back to back in one file, mapped into memory. Images handed out are
+    # views onto the mapping rather than copies, so all the processes rendering share one copy through the page
+    # cache. The images are read only, copy them before drawing on them
+    def __init__(self, atlas_path, asset_dir=CARD_ASSETS_DIR):
+        self.asset_dir = asset_dir
+        with open(atlas_path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        header_size, = struct.unpack_from('<Q', self._map)
+        header = json.loads(self._view[8:8 + header_size].tobytes())
+        self.version = header['version']
+        self.sources = header['sources']
+        self.entries = header['entries']
+        self._data_start = _data_start(header_size)
+
+    def is_current(self, sources):
+        return self.version == ATLAS_VERSION and self.sources == sources
+
+    def get(self, file_path, size):
+        try:
+            offset, width, height = self.entries[atlas_key(file_path, size, self.asset_dir)]
+        except (KeyError, ValueError):
+            return None
+        start = self._data_start + offset
+        return Image.frombuffer('RGBA', (width, height), self._view[start:start + width * height * 4], 'raw', 'RGBA', 0, 1)
+
+    def close(self):
+        # Only possible while no image from it is still around
+        self._view.release()
+        self._map.close()
+
+
+def build_atlas(atlas_path=ASSET_ATLAS_PATH, asset_dir=CARD_ASSETS_DIR, sources=None):
+    sources = asset_sources(asset_dir) if sources is None else sources
+    entries = {}
+    offset = 0
+    for relative_path, (_, _, sizes) in sources.items():
+        for width, height in sizes:
+            entries[atlas_key(asset_dir / relative_path, (width, height), asset_dir)] = [offset, width, height]
+            offset += width * height * 4
+    header = json.dumps({'version': ATLAS_VERSION, 'sources': sources, 'entries': entries}).encode('utf-8')
+
+    atlas_path = Path(atlas_path)
+    atlas_path.parent.mkdir(parents=True, exist_ok=True)
+    # Renamed over the old atlas once written, so readers only ever see a whole one
+    try:
+        with atomic_write(atlas_path) as tmp_path, open(tmp_path, 'wb') as f:
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.write(bytes(_data_start(len(header)) - 8 - len(header)))
+            # Sizes are known up front, so each asset is decoded and written out one at a time
+            for relative_path, (_, _, sizes) in sources.items():
+                for size in sizes:
+                    f.write(get_img(asset_dir / relative_path, tuple(size)).tobytes())
+    except PermissionError:
+        # Windows won't replace a file another process still has mapped, its workers keep using the old atlas
+        # (and decode whatever changed) until they're gone
+        return False
+    return True
+
+
+def open_atlas(atlas_path=ASSET_ATLAS_PATH, asset_dir=CARD_ASSETS_DIR, sources=None):
+    # The atlas, or None if it's missing, unreadable or older than any asset
+    sources = asset_sources(asset_dir) if sources is None else sources
+    try:
+        atlas = AssetAtlas(atlas_path, asset_dir)
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
+    if not atlas.is_current(sources):
+        atlas.close()
+        return None
+    return atlas
+
+
+def update_atlas(atlas_path=ASSET_ATLAS_PATH, asset_dir=CARD_ASSETS_DIR):
+    # Repacks the atlas if any asset changed since it was packed. Called before starting render workers, which
+    # only ever open it
+    sources = asset_sources(asset_dir)
+    atlas = open_atlas(atlas_path, asset_dir, sources)
+    if atlas is not None:
+        atlas.close()
+        return False
+    return build_atlas(atlas_path, asset_dir, sources)
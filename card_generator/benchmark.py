@@ -0,0 +1,221 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+from config import *
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory isn't reported
+    resource = None
+
+
+BENCHMARKS = ('render', 'text', 'sheets', 'deck_object')
+
+
+def scaled_cube(cube, rows):
+    # Cycles through the real cards, so a synthetic cube keeps the same mix of formats, biomes and text lengths
+    return [cube[k % len(cube)] for k in range(rows)]
+
+
+def make_stub_sprite(sprite_path, size=(512, 512)):
+    img = Image.new('RGBA', size)
+    d = ImageDraw.Draw(img)
+    d.ellipse((size[0] // 8, size[1] // 8, size[0] * 7 // 8, size[1] * 7 // 8), fill=(200, 80, 60, 255))
+    img.save(sprite_path)
+
+
+def _offline(*args, **kwargs):
+    import requests
+    raise requests.ConnectionError('benchmarks run offline')
+
+
+def _stub_pipeline(work_dir, rows):
+    # Every stage reads the same fixed cube and one local sprite, and writes under work_dir. Caches that persist
+    # between builds start out empty there too, so every run measures the same cold start
+    from functools import partial
+
+    import requests
+    import asset_atlas
+    import generate_deck_object
+    import generate_decks
+    import generate_pokemon
+    import sprite_cache
+    import text_cache
+    from utils import read_cube
+
+    requests.Session.request = _offline
+    cube = scaled_cube(read_cube(), rows) if rows else read_cube()
+    for module in (generate_pokemon, generate_decks, generate_deck_object):
+        module.read_cube = lambda: cube
+
+    stub_sprite = work_dir / 'sprite.png'
+    generate_pokemon.sprite_paths = lambda stats: [stub_sprite]
+    generate_pokemon.CARD_FRONTS_OUTPUT_DIR = work_dir / 'card_fronts'
+    generate_pokemon.CARD_FRONTS_MANIFEST = work_dir / 'card_fronts_manifest.json'
+    sprite_cache.SPRITE_CACHE_DIR = work_dir / 'sprites'
+    text_cache.TEXT_LAYER_CACHE_DIR = work_dir / 'text_layers'
+    text_cache._layers.clear()
+    generate_pokemon.open_atlas = partial(asset_atlas.open_atlas, work_dir / 'assets.atlas')
+    generate_pokemon.update_atlas = partial(asset_atlas.update_atlas, work_dir / 'assets.atlas')
+    generate_decks.DECKS_OUTPUT_DIR = work_dir / 'decks'
+    generate_decks.input = lambda *args: ''
+    generate_deck_object.DECK_OBJECT_OUTPUT_DIR = work_dir / 'deck_object'
+    return cube
+
+
+def bench_render(cube, work_dir, workers):
+    import generate_pokemon
+
+    start = time.perf_counter()
+    generate_pokemon.run(overwrite=True, workers=workers)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'items': len(cube), 'rate': len(cube) / seconds, 'unit': 'cards/s'}
+
+
+def bench_text(cube, work_dir, workers):
+    from benchmark_text import collect_text_jobs, _time_jobs
+    from utils import fit_text, _word_widths, _line_heights
+
+    jobs = collect_text_jobs(cube)
+    _word_widths.clear()
+    _line_heights.clear()
+    seconds, _ = _time_jobs(fit_text, jobs, 1)
+    warm_seconds, _ = _time_jobs(fit_text, jobs, 3)
+    return {
+        'seconds': seconds, 'items': len(jobs), 'rate': len(jobs) / seconds, 'unit': 'text blocks/s',
+        'warm_seconds': warm_seconds, 'ms_per_block': 1000 * seconds / max(len(jobs), 1),
+    }
+
+
+def bench_sheets(cube, work_dir, workers):
+    import generate_decks
+
+    start = time.perf_counter()
+    generate_decks.run(workers=workers)
+    seconds = time.perf_counter() - start
+    sheets = -(-len(cube) // CARDS_PER_SHEET)
+    return {'seconds': seconds, 'items': sheets, 'rate': sheets / seconds, 'unit': 'sheets/s'}
+
+
+def bench_deck_object(cube, work_dir, workers):
+    import generate_deck_object
+
+    sheet_urls_path = work_dir / 'sheet_urls.json'
+    sheet_urls = {
+        str(j): {'FaceURL': f'https://example.com/{j}a.png', 'BackURL': f'https://example.com/{j}b.png'}
+        for j in range(-(-len(cube) // CARDS_PER_SHEET))
+    }
+    sheet_urls_path.write_text(json.dumps(sheet_urls))
+
+    start = time.perf_counter()
+    generate_deck_object.run(sheet_urls_path=sheet_urls_path)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'items': len(cube), 'rate': len(cube) / seconds, 'unit': 'cards/s'}
+
+
+def _peak_rss_mb(who):
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    return resource.getrusage(who).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def _run_benchmark(name, work_dir, rows, workers, results):
+    try:
+        cube = _stub_pipeline(work_dir, rows)
+        result = globals()[f'bench_{name}'](cube, work_dir, workers)
+    except BaseException:
+        # Let the parent stop waiting, the traceback is printed by the process itself
+        results.put(None)
+        raise
+    # Render and sheet workers are counted separately from the benchmark process itself
+    result['peak_rss_mb'] = _peak_rss_mb(resource and resource.RUSAGE_SELF)
+    result['peak_worker_rss_mb'] = _peak_rss_mb(resource and resource.RUSAGE_CHILDREN)
+    results.put(result)
+
+
+def run(benchmarks=BENCHMARKS, rows=None, workers=None, output_path=None):
+    # Each benchmark runs in a fresh process so peak memory is its own. The stubs only reach pool workers forked
+    # from it, so where processes can't be forked the stages run in-process
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context('spawn')
+        workers = 1
+    report = {
+        'meta': {
+            'rows': rows, 'workers': workers, 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'benchmarks': {},
+    }
+
+    results = context.Queue()
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_dir = Path(work_dir)
+        make_stub_sprite(work_dir / 'sprite.png')
+        # Sheets are built from the rendered cards, so rendering always comes first
+        for name in sorted(benchmarks, key=BENCHMARKS.index):
+            print(f'Benchmarking {name}:')
+            process = context.Process(target=_run_benchmark, args=(name, work_dir, rows, workers, results))
+            process.start()
+            result = results.get()
+            process.join()
+            if result is None:
+                raise RuntimeError(f'The {name} benchmark failed')
+            report['benchmarks'][name] = result
+            print(f"{name}: {result['seconds']:.3f}s, {result['rate']:.1f} {result['unit']}, peak {result['peak_rss_mb'] or 0:.0f} MB")
+
+    output_path = Path(output_path or BENCHMARK_OUTPUT_DIR / f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {output_path}')
+    return report
+
+
+def compare(report, baseline, threshold=BENCHMARK_THRESHOLD):
+    if report['meta']['rows'] != baseline['meta']['rows']:
+        print(f"Warning: the baseline ran on {baseline['meta']['rows'] or 'the bundled'} rows, this run on {report['meta']['rows'] or 'the bundled'}")
+
+    regressions = []
+    for name, result in report['benchmarks'].items():
+        previous = baseline['benchmarks'].get(name)
+        if previous is None:
+            continue
+        change = result['seconds'] / previous['seconds'] - 1
+        regressed = change > threshold
+        print(f"{name:<12} {previous['seconds']:8.3f}s -> {result['seconds']:8.3f}s {change:+7.1%}{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', action='append', choices=BENCHMARKS, default=None, help='benchmark to run, repeatable (default: all)')
+    parser.add_argument('--rows', type=int, default=None,
+                        help='run on a synthetic cube of this many cards cycled from the bundled one (default: the bundled cube)')
+    parser.add_argument('--workers', type=int, default=None, help='number of render and sheet processes (default: one per core)')
+    parser.add_argument('--output', default=None, help='where to write the results (default: output/benchmarks/benchmark-<time>.json)')
+    parser.add_argument('--baseline', default=None, help='earlier results to compare against')
+    parser.add_argument('--threshold', type=float, default=BENCHMARK_THRESHOLD,
+                        help='fraction a benchmark may slow down by before it counts as a regression')
+    args = parser.parse_args()
+
+    report = run(args.only or BENCHMARKS, args.rows, args.workers, args.output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print(f"Regressed beyond {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
@@ -0,0 +1,81 @@
+import argparse
+import time
+import warnings
+
+from PIL import Image, ImageDraw, ImageFont
+
+import generate_pokemon
+from utils import xy, read_cube, fit_text, _word_widths, _line_heights
+
+
+def collect_text_jobs(cube):
+    # Record every ability/mode text block the card formats would fit, without drawing anything
+    jobs = []
+
+    def record_text(d, text, font, boundaries, alignment, *args, **kwargs):
+        jobs.append((text, font, boundaries))
+
+    d = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+    original_wrapped_text = generate_pokemon.wrapped_text
+    generate_pokemon.wrapped_text = record_text
+    try:
+        for stats in cube:
+            generate_pokemon.SetUpTextForFormats(d, generate_pokemon.GetFormat(stats), stats)
+    finally:
+        generate_pokemon.wrapped_text = original_wrapped_text
+    return jobs
+
+
+def legacy_fit_text(d, text, font, boundaries):
+    # The recursive word by word fitting wrapped_text used before the fitting engine, minus the drawing
+    words = text.split(' ')
+    multiline_text_list = []
+    for word in words:
+        if not multiline_text_list or d.textsize(f'{multiline_text_list[-1]} {word}', font)[0] >= xy(*boundaries)[0]:
+            multiline_text_list.append('')
+        multiline_text_list[-1] += word + ' '
+
+    multiline_text = '\n'.join(multiline_text_list).strip()
+    if d.textsize(multiline_text, font)[0] >= xy(*boundaries)[0] or d.textsize(multiline_text, font)[1] >= xy(*boundaries)[1]:
+        smaller_font = ImageFont.truetype(font.path, size=font.size - 2)
+        return legacy_fit_text(d, text, smaller_font, boundaries)
+    return font.size, multiline_text
+
+
+def _time_jobs(fit, jobs, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [fit(*job) for job in jobs]
+    return (time.perf_counter() - start) / repeat, results
+
+
+def run(repeat=1):
+    jobs = collect_text_jobs(read_cube())
+    d = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        legacy_time, legacy_results = _time_jobs(lambda *job: legacy_fit_text(d, *job), jobs, repeat)
+
+    _word_widths.clear()
+    _line_heights.clear()
+    cold_time, _ = _time_jobs(fit_text, jobs, 1)
+    warm_time, results = _time_jobs(fit_text, jobs, repeat)
+
+    mismatches = sum(
+        (layout.font.size, layout.text) != legacy_result
+        for layout, legacy_result in zip(results, legacy_results)
+    )
+    print(f'{len(jobs)} text blocks')
+    print(f'legacy wrapped_text: {legacy_time * 1000:.1f} ms')
+    print(f'fit_text (cold):     {cold_time * 1000:.1f} ms')
+    print(f'fit_text (warm):     {warm_time * 1000:.1f} ms')
+    print(f'layouts differing from legacy: {mismatches}')
+    return {'jobs': len(jobs), 'legacy': legacy_time, 'cold': cold_time, 'warm': warm_time, 'mismatches': mismatches}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+    run(repeat=args.repeat)
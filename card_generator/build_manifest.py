@@ -0,0 +1,57 @@
+import hashlib
+import json
+import os
+
+from config import *
+from io_utils import atomic_write
+
+
+# Digest of every file hashed so far, reused while its mtime and size are unchanged
+_file_hashes = {}
+
+
+def file_hash(file_path):
+    file_path = str(file_path)
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+
+    cached = _file_hashes.get(file_path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    _file_hashes[file_path] = (stat.st_mtime_ns, stat.st_size, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def _relative_path(file_path):
+    try:
+        return Path(file_path).resolve().relative_to(ROOT_DIR.resolve()).as_posix()
+    except ValueError:
+        return str(file_path)
+
+
+def fingerprint(fields, input_paths):
+    inputs = {_relative_path(file_path): file_hash(file_path) for file_path in input_paths}
+    payload = json.dumps({'fields': fields, 'inputs': inputs}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)['cards']
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return {}
+
+
+def save_manifest(manifest_path, cards):
+    manifest_path = Path(manifest_path)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_write(manifest_path) as tmp_path, open(tmp_path, 'w') as f:
+        json.dump({'cards': cards}, f, indent=1, sort_keys=True)
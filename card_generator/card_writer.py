@@ -0,0 +1,39 @@
+from config import *
+from front_encoder import FrontEncoder
+from io_utils import WorkerQueue, atomic_write
+from profiling import StageTimer
+
+
+def save_card_front(img, output_path, encoder=FrontEncoder()):
+    # An interrupted save leaves at most a temporary file, which never passes for a rendered card
+    with atomic_write(output_path) as tmp_path:
+        img.save(tmp_path, format='PNG', compress_level=encoder.compress_level, optimize=encoder.optimize)
+
+
+def remove_partial_writes(output_dir):
+    # Temporary files left behind by render processes that were killed mid save
+    partial = list(Path(output_dir).glob('*.png.*.tmp'))
+    for tmp_path in partial:
+        tmp_path.unlink(missing_ok=True)
+    return len(partial)
+
+
+class CardWriter:
+    # Encodes and saves card fronts on background threads while the caller draws the next ones. Pillow lets go of
+    # the GIL while compressing, so encoding runs alongside drawing rather than after it. put() only blocks once
+    # queue_size cards are waiting, which bounds the memory held by finished cards
+    def __init__(self, encoder=FrontEncoder(), threads=CARD_WRITER_THREADS, queue_size=CARD_WRITER_QUEUE_SIZE):
+        self.encoder = encoder
+        self._savers = WorkerQueue(self._save, threads, queue_size)
+
+    def put(self, img, output_path, timer=None):
+        # The time spent saving lands in timer's save stage once the card is on disk
+        self._savers.put(img, output_path, timer or StageTimer())
+
+    def _save(self, img, output_path, timer):
+        with timer.stage('save'):
+            save_card_front(img, output_path, self.encoder)
+
+    def close(self):
+        # Returns once every card put is on disk, raising the first error saving any of them
+        self._savers.close()
@@ -1,27 +1,95 @@
+import os
 from pathlib import Path
 
+# Rendering
+# Cards are drawn at RENDER_SCALE times full size (1024x1472). It's read from the environment so render workers,
+# which may import everything afresh, draw at the same scale (main.py sets it for --draft and --scale)
+RENDER_SCALE = float(os.environ.get('CARD_RENDER_SCALE', 1))
+DRAFT_SCALE = 0.25
+# Card fronts are encoded and saved on background threads of each render process while it draws the next ones.
+# Level 6 is what Pillow uses when not told, optimize trades a lot more encoding time for slightly smaller files
+CARD_COMPRESS_LEVEL = 6
+CARD_OPTIMIZE = False
+CARD_WRITER_THREADS = 2
+# Finished cards waiting to be saved before drawing waits, about 6 MB each at full size
+CARD_WRITER_QUEUE_SIZE = 4
+# Cards a render process draws before handing them back, which it does once all of them are safely on disk
+CARD_BATCH_SIZE = 16
+
 # File Paths
 COMPONENT_DIR = Path(__file__).parent
 ROOT_DIR = COMPONENT_DIR.parent
 CARD_ASSETS_DIR = COMPONENT_DIR.parent / 'assets' / 'card_generator'
-OUTPUT_DIR = COMPONENT_DIR / 'output'
+# Drafts get an output directory, manifest and caches of their own, so they never mix with the full size build
+OUTPUT_DIR = COMPONENT_DIR / 'output' if RENDER_SCALE == 1 else COMPONENT_DIR / 'output' / f'draft-{RENDER_SCALE:g}'
 CARD_FRONTS_OUTPUT_DIR = OUTPUT_DIR / 'card_fronts'
 CARD_BACKS_OUTPUT_DIR = OUTPUT_DIR / 'card_backs'
 DECKS_OUTPUT_DIR = OUTPUT_DIR / 'decks'
 DECK_OBJECT_OUTPUT_DIR = OUTPUT_DIR / 'deck_object'
+CARD_FRONTS_MANIFEST = OUTPUT_DIR / 'card_fronts_manifest.json'
+SHARDS_OUTPUT_DIR = OUTPUT_DIR / 'shards'
+CACHE_DIR = OUTPUT_DIR / '.cache'
+CUBE_CACHE_DIR = CACHE_DIR
+SPRITE_CACHE_DIR = CACHE_DIR / 'sprites'
+TEXT_LAYER_CACHE_DIR = CACHE_DIR / 'text_layers'
+ASSET_ATLAS_PATH = CACHE_DIR / 'assets.atlas'
+PROFILE_OUTPUT_DIR = OUTPUT_DIR / 'profile'
+BENCHMARK_OUTPUT_DIR = OUTPUT_DIR / 'benchmarks'
 CARD_FRONTS_DECK_IMG = '{j}a_deck.png'
 CARD_BACKS_DECK_IMG = '{j}b_deck.png'
+CARDS_PER_SHEET = 70
+# Rendered cards waiting to be placed on a sheet before rendering waits, about 1.5 MB each
+PIPELINE_QUEUE_SIZE = 32
+SHEET_FORMAT = 'png'
+SHEET_COMPRESS_LEVEL = 6
+SHEET_QUALITY = 90
+# Card fronts each sheet decodes and resizes at once
+SHEET_LOAD_THREADS = 4
 CARD_OBJECT_TEMPLATE = CARD_ASSETS_DIR / 'object_templates' / 'card.json'
 DECK_OBJECT_TEMPLATE = CARD_ASSETS_DIR / 'object_templates' / 'deck.json'
 
+# Caches
+ASSET_CACHE_SIZE = 128
+# Prebuilt card backgrounds kept per process, about 6 MB each
+BACKGROUND_CACHE_SIZE = 16
+# Rasterized blocks of text kept per process, a few KB to a few hundred KB each
+TEXT_LAYER_CACHE_SIZE = 512
+PRELOAD_ASSETS = False
+# Render workers map the decoded assets from one packed file instead of each decoding their own copies
+USE_ASSET_ATLAS = True
+
+# Profiling
+PROFILE_TOP_N = 10
+# Fraction a benchmark may slow down by against its baseline before it fails
+BENCHMARK_THRESHOLD = 0.1
+
+# Preview server
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8765
+SERVER_CACHE_SIZE = 256
+SERVER_SHEET_CACHE_SIZE = 2
+SERVER_WATCH_INTERVAL = 1.0
+SERVER_COMPRESS_LEVEL = 1
+
 # URLs
 ART_FORM_URL  = 'https://raw.githubusercontent.com/PokeAPI/sprites/master/sprites/pokemon/other/home'
 ART_FORM_URL2 = 'https://www.serebii.net/pokemon/art'
+# Mirrors tried in order for missing art, with which variant of the pokedex number each one names its files by
+SPRITE_MIRRORS = ((ART_FORM_URL, 0), (ART_FORM_URL2, 1))
+
+# Sprite prefetching
+PREFETCH_CONCURRENCY = 8
+PREFETCH_TIMEOUT = 10
+PREFETCH_RETRIES = 3
+PREFETCH_BACKOFF = 0.5
+MISSING_SPRITES_REPORT = OUTPUT_DIR / 'missing_sprites.json'
 
 # Fonts
 FONT_DIR = CARD_ASSETS_DIR / 'fonts'
 ORIENTAL_PATH = str(FONT_DIR / 'la_oriental.otf')
 BARLOW_PATH = str(FONT_DIR / 'barlow.ttf')
+TEXT_FONT_SIZES = (20, 25, 30, 36, 44)
+TITLE_FONT_SIZES = (27, 32, 40)
 
 # Colours
 DARK_COLOUR = (37, 37, 50)
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import pickle
+from dataclasses import dataclass, fields
+from typing import Optional
+
+from config import *
+from io_utils import atomic_write
+
+
+# Bump whenever Card changes, so snapshots pickled with the old fields are parsed again
+SNAPSHOT_VERSION = 1
+
+
+@dataclass(slots=True, frozen=True)
+class Card:
+    cardNumber: Optional[int] = None
+    pokedex_name: Optional[str] = None
+    pokedex_number: Optional[str] = None
+    color: Optional[str] = None
+    type_1: Optional[str] = None
+    type_2: Optional[str] = None
+    biome: Optional[str] = None
+    health: Optional[int] = None
+    attack: Optional[int] = None
+    cost: Optional[int] = None
+    tags: Optional[str] = None
+    ability_name: Optional[str] = None
+    ability: Optional[str] = None
+    mode_1_name: Optional[str] = None
+    mode_1_ability: Optional[str] = None
+    mode_2_name: Optional[str] = None
+    mode_2_ability: Optional[str] = None
+    mode_3_name: Optional[str] = None
+    mode_3_ability: Optional[str] = None
+    number_in_deck: Optional[int] = None
+    cardActionBox: Optional[str] = None
+
+    def items(self):
+        return ((field.name, getattr(self, field.name)) for field in fields(self))
+
+
+def _to_int(value):
+    if value is None or value == '':
+        return None
+    return int(float(value)) if isinstance(value, (float, str)) else int(value)
+
+
+def _to_str(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+_CONVERTERS = {field.name: (_to_int if field.type == Optional[int] else _to_str) for field in fields(Card)}
+
+
+def parse_cube(cube_path, sheet_name='pokemon'):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(cube_path, read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet_name].iter_rows(values_only=True)
+        header = next(rows)
+        columns = [(i, name) for i, name in enumerate(header) if name in _CONVERTERS]
+        return [
+            Card(**{name: _CONVERTERS[name](row[i]) for i, name in columns})
+            for row in rows
+            # Blank rows, like the formatted but empty ones after the last card, aren't cards
+            if any(value is not None for value in row)
+        ]
+    finally:
+        workbook.close()
+
+
+def _file_digest(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_cube(cube_name='pokemon_dominion', sheet_name='pokemon'):
+    # Parsing the xlsx dominates startup, so the parsed cards are kept in a pickle next to the outputs. The mtime
+    # and size are checked first, and only if those changed is the file hashed to see whether it really did
+    cube_path = ROOT_DIR / f'{cube_name}.xlsx'
+    snapshot_path = CUBE_CACHE_DIR / f'{cube_name}-{sheet_name}.pickle'
+    stat = os.stat(cube_path)
+
+    snapshot = None
+    try:
+        with open(snapshot_path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except (FileNotFoundError, pickle.UnpicklingError, EOFError, AttributeError, TypeError):
+        pass
+
+    if snapshot and snapshot['version'] == SNAPSHOT_VERSION:
+        if snapshot['mtime_ns'] == stat.st_mtime_ns and snapshot['size'] == stat.st_size:
+            return snapshot['cards']
+        digest = _file_digest(cube_path)
+        if snapshot['digest'] == digest:
+            snapshot.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            _save_snapshot(snapshot_path, snapshot)
+            return snapshot['cards']
+    else:
+        digest = _file_digest(cube_path)
+
+    cards = parse_cube(cube_path, sheet_name)
+    _save_snapshot(snapshot_path, {
+        'version': SNAPSHOT_VERSION,
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'digest': digest,
+        'cards': cards,
+    })
+    return cards
+
+
+def read_cube(cube_name='pokemon_dominion', sheet_name='pokemon'):
+    return load_cube(cube_name, sheet_name)
+
+
+def _save_snapshot(snapshot_path, snapshot):
+    snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+    # Shards rendering from one checkout may parse the cube at once, each writes its own file and the last rename wins
+    with atomic_write(snapshot_path) as tmp_path, open(tmp_path, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,16 @@
+from collections import namedtuple
+
+from config import *
+
+
+FrontEncoder = namedtuple('FrontEncoder', ['compress_level', 'optimize'], defaults=(CARD_COMPRESS_LEVEL, CARD_OPTIMIZE))
+
+
+def add_front_encoder_arguments(parser):
+    parser.add_argument('--front-compress-level', type=int, default=CARD_COMPRESS_LEVEL, help='zlib level for the card fronts, 0-9')
+    parser.add_argument('--optimize-fronts', action='store_true', default=CARD_OPTIMIZE,
+                        help='squeeze the card fronts a little smaller, at several times the encoding time')
+
+
+def get_front_encoder(args):
+    return FrontEncoder(args.front_compress_level, args.optimize_fronts)
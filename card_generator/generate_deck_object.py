@@ -1,9 +1,12 @@
+import argparse
 import json
-
-import pandas as pd
+from contextlib import ExitStack
+from functools import lru_cache
 
 from config import *
-from utils import read_cube
+from cube import read_cube
+from io_utils import atomic_write
+from profiling import StageTimer, ProfileReport, cprofiled
 
 
 def get_tags(stats, is_evolution=False):
@@ -13,100 +16,176 @@ def get_tags(stats, is_evolution=False):
             "Pokemon Card",
             stats.biome
         ]
-        if not pd.isnull(tag)
+        if tag is not None
     ]
 
 
 def get_lua_table_from_fields(fields):
-    values_list = [f'"{value.capitalize()}"' for value in fields if not pd.isnull(value)]
+    values_list = [f'"{value.capitalize()}"' for value in fields if value is not None]
     values_str = ','.join(values_list)
     return '{' + values_str + '}'
 
 
 def get_lua_table_from_field(field):
-    if not pd.isnull(field):
+    if field is not None:
         values_list = [f'"{value}"' for value in field.split('/')]
         values_str = ','.join(values_list)
         return '{' + values_str + '}'
     return 'nil'
 
 
+def get_lua_number(value):
+    return 'nil' if value is None else value
+
+
 def get_lua_script(stats):
     local_variables = {
         'pokedex_number': f'"{stats.pokedex_number}"',
         'pokedex_name': f'"{stats.pokedex_name}"',
-        'cost': stats.cost,
-        'attack': stats.attack,
+        'cost': get_lua_number(stats.cost),
+        'attack': get_lua_number(stats.attack),
         'types': get_lua_table_from_fields((stats.type_1, stats.type_2)),
     }
     lua_script_lines = [f'{variable} = {value}' for variable, value in local_variables.items()]
     return '\n'.join(lua_script_lines)
 
 
-def get_card_json(deck_json, i, j, stats, is_evolution=False):
-    with open(CARD_OBJECT_TEMPLATE) as f:
-        card_json = json.load(f)
+@lru_cache(maxsize=None)
+def load_template(template_path):
+    with open(template_path) as f:
+        return json.load(f)
 
-    card_json['CardID'] = j * 100 + i
-    # TODO: This needs a long term solution for handling evolution
-    card_json['Nickname'] = stats.pokedex_name
-    card_json['Description'] = ''
-    card_json['Tags'] = get_tags(stats, is_evolution)
-    card_json['LuaScript'] = get_lua_script(stats)
-    card_json['CustomDeck'][str(j)] = {
-        'FaceURL': deck_json['ObjectStates'][0]['CustomDeck'][str(j)]['FaceURL'],
-        'BackURL': deck_json['ObjectStates'][0]['CustomDeck'][str(j)]['BackURL'],
+
+def get_custom_deck(face_url, back_url):
+    return {
+        'FaceURL': face_url,
+        'BackURL': back_url,
         'NumWidth': 10,
         'NumHeight': 7,
         'BackIsHidden': True,
         'UniqueBack': True,
         'Type': 0
     }
-    return card_json
 
 
-def add_card_to_deck(deck_json, i, j, k, stats):
-    card_json = get_card_json(deck_json, i, j, stats, is_evolution=(k != 0))
-    
-    deck_json['ObjectStates'][0]['DeckIDs'].append(j * 100 + i)
-    deck_json['ObjectStates'][0]['ContainedObjects'].append(card_json)
+def get_card_json(card_template, custom_deck, i, j, stats, is_evolution=False):
+    # Only top level keys differ between cards, so a shallow copy can share everything else with the template
+    card_json = dict(card_template)
+    card_json['CardID'] = j * 100 + i
+    # TODO: This needs a long term solution for handling evolution
+    card_json['Nickname'] = stats.pokedex_name
+    card_json['Description'] = ''
+    card_json['Tags'] = get_tags(stats, is_evolution)
+    card_json['LuaScript'] = get_lua_script(stats)
+    card_json['CustomDeck'] = {str(j): custom_deck}
+    return card_json
 
 
-def run():
-    print('Generating deck object:')
+class DeckObjectWriter:
+    # Streams cards into the ContainedObjects array as they are added. DeckIDs and CustomDeck are written after it,
+    # so neither the cards nor the sheet URLs have to be known up front
+    def __init__(self, output_path, deck_template):
+        self.output_path = Path(output_path)
+        self._deck_template = deck_template['ObjectStates'][0]
+        self._deck_ids = []
+        self._custom_deck = {}
+        self._f = None
+        self._files = None
+
+    def __enter__(self):
+        with ExitStack() as files:
+            self._f = files.enter_context(open(files.enter_context(atomic_write(self.output_path)), 'w'))
+            self._f.write('{"ObjectStates": [{')
+            for key, value in self._deck_template.items():
+                if key not in ('DeckIDs', 'CustomDeck', 'ContainedObjects'):
+                    self._f.write(f'{json.dumps(key)}: {json.dumps(value)}, ')
+            self._f.write('"ContainedObjects": [')
+            # Kept open until __exit__, unless writing the start of the file already failed
+            self._files = files.pop_all()
+        return self
+
+    def add_sheet(self, j, face_url, back_url):
+        self._custom_deck[str(j)] = get_custom_deck(face_url, back_url)
+        return self._custom_deck[str(j)]
+
+    def add_card(self, card_json):
+        if self._deck_ids:
+            self._f.write(', ')
+        json.dump(card_json, self._f)
+        self._deck_ids.append(card_json['CardID'])
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Closing the files renames the finished deck object into place, or removes it if adding cards failed
+        if exc_type is not None:
+            return self._files.__exit__(exc_type, exc_value, traceback)
+        with self._files:
+            self._f.write(f'], "DeckIDs": {json.dumps(self._deck_ids)}, "CustomDeck": {json.dumps(self._custom_deck)}}}]}}')
+
+
+def load_sheet_urls(sheet_urls_path):
+    # {"0": {"FaceURL": "...", "BackURL": "..."}, "1": ...}, keyed by the number in the sheet file names
+    with open(sheet_urls_path) as f:
+        return {int(j): (urls['FaceURL'], urls['BackURL']) for j, urls in json.load(f).items()}
+
+
+def get_sheet_urls(j, sheet_urls=None):
+    if sheet_urls is None:
+        face_url = input(f'Enter the Cloud URL for {CARD_FRONTS_DECK_IMG.format(j=j)}:\n')
+        back_url = input(f'Enter the Cloud URL for {CARD_BACKS_DECK_IMG.format(j=j)}:\n')
+        return face_url, back_url
+    if j not in sheet_urls:
+        raise KeyError(f'No FaceURL/BackURL given for sheet {j} in the sheet URL file')
+    return sheet_urls[j]
+
+
+def get_number_in_deck(stats):
+    # Rows without a count are a single card
+    return 1 if stats.number_in_deck is None else int(stats.number_in_deck)
+
+
+def write_deck_object(cube, sheet_urls=None, timer=None):
+    timer = timer or StageTimer()
+    card_template = load_template(CARD_OBJECT_TEMPLATE)
+    output_path = DECK_OBJECT_OUTPUT_DIR / 'deck.json'
     DECK_OBJECT_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
-    with open(DECK_OBJECT_TEMPLATE) as f:
-        deck_json = json.load(f)
-    output_path = DECK_OBJECT_OUTPUT_DIR / 'deck.json'
+    with DeckObjectWriter(output_path, load_template(DECK_OBJECT_TEMPLATE)) as deck:
+        for row, stats in enumerate(cube):
+            # Tabletop Simulator numbers custom decks from 1, the sheet files from 0
+            sheet, i = divmod(row, CARDS_PER_SHEET)
+            j = sheet + 1
+            if i == 0:
+                custom_deck = deck.add_sheet(j, *get_sheet_urls(sheet, sheet_urls))
 
-    i, j = 0, 0
-    for _, stats in read_cube().iterrows():
-        if (i == 0 and j == 0) or i == 70:
-            deck_json['ObjectStates'][0]['CustomDeck'][str(j + 1)] = {
-                'NumWidth': 10,
-                'NumHeight': 7,
-                'BackIsHidden': True,
-                'UniqueBack': True,
-                'Type': 0
-            }
-            face_url = input(f'Enter the Cloud URL for {CARD_FRONTS_DECK_IMG.format(j=j)}:\n')
-            deck_json['ObjectStates'][0]['CustomDeck'][str(j + 1)]['FaceURL'] = face_url
-            back_url = input(f'Enter the Cloud URL for {CARD_BACKS_DECK_IMG.format(j=j)}:\n')
-            deck_json['ObjectStates'][0]['CustomDeck'][str(j + 1)]['BackURL'] = back_url
-            i = 0
-            j += 1
-
-        for k in range(stats.number_in_deck):
-            add_card_to_deck(deck_json, i, j, k, stats)
-
-        i += 1
-    else:
-        with open(output_path, 'w') as f:
-            json.dump(deck_json, f)
+            with timer.stage('write_cards'):
+                for k in range(get_number_in_deck(stats)):
+                    deck.add_card(get_card_json(card_template, custom_deck, i, j, stats, is_evolution=(k != 0)))
+    return output_path
+
+
+def run(sheet_urls_path=None, profile=False):
+    print('Generating deck object:')
+    timer = StageTimer()
+
+    sheet_urls = load_sheet_urls(sheet_urls_path) if sheet_urls_path else None
+    with timer.stage('load'):
+        cube = read_cube()
+    output_path = write_deck_object(cube, sheet_urls, timer)
+    if profile:
+        report = ProfileReport('deck_object')
+        report.add(output_path.name, timer.stages)
+        report.save()
+        report.print_summary()
     print(
         'Now place the deck.json file found in output/deck_object into your local Documents/My Games/Tabletop Simulator/Saves/Saved Objects folder, you can now import them in Tabletop Simulator by going to Objects -> Saved Objects.')
 
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--urls', default=None,
+                        help='JSON file mapping each sheet number to its FaceURL and BackURL, instead of asking for them')
+    parser.add_argument('--profile', action='store_true', help='report the time spent loading the cube and writing cards')
+    parser.add_argument('--cprofile', action='store_true', help='run under cProfile and dump the stats to output/profile/generate_deck_object.pstats')
+    args = parser.parse_args()
+    with cprofiled(PROFILE_OUTPUT_DIR / 'generate_deck_object.pstats' if args.cprofile else None):
+        run(sheet_urls_path=args.urls, profile=args.profile)
@@ -1,52 +1,313 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+from io import BytesIO
+from multiprocessing import Pool
+
+import numpy as np
 from PIL import Image
 from tqdm import tqdm
 
 from config import *
-from utils import xy, pos, read_cube, get_img
+from generate_pokemon import card_front_path
+from io_utils import WorkerQueue
+from profiling import StageTimer, ProfileReport, cprofiled
+from sheet_encoder import SHEET_EXTENSIONS, SheetEncoder, add_encoder_arguments, get_encoder
+from utils import xy, pos, read_cube, get_img, get_asset
 
 
-def get_card_deck_base_img():
-    return Image.new('RGBA', pos(10, 7))
+SHEET_CARD_SIZE = xy(8, 11.5)
 
 
-def add_card_at_pos(base_img, pokemon_card_path, position):
-    img = get_img(pokemon_card_path, xy(8, 11.5))
-    base_img.paste(img, position, img)
-    return base_img
+def get_card_pos(i):
+    return pos(i % 10, (i // 10) % 7)
 
 
-def run():
-    print('Generating decks:')
-    DECKS_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+def blend_onto_transparent(pixels):
+    # What pasting RGBA pixels with their own alpha as the mask onto a transparent sheet gives: every channel,
+    # alpha included, scaled by the alpha with PIL's rounding
+    scaled = pixels.astype(np.uint16) * pixels[..., 3:] + 128
+    return ((scaled + (scaled >> 8)) >> 8).astype(np.uint8)
+
+
+class SheetCanvas:
+    # A sheet held as one preallocated RGBA array. Slots never overlap and start out transparent, so a card is
+    # placed by copying it straight in and then blending only its pixels that aren't fully opaque (the rounded
+    # corners and edges, a percent or so of the card), and the image is only made once the sheet is done
+    def __init__(self):
+        width, height = pos(10, 7)
+        self.pixels = np.zeros((height, width, 4), dtype=np.uint8)
+
+    def add(self, card_img, slot):
+        self.add_all(card_img, (slot,))
+
+    def add_all(self, card_img, slots):
+        # The same card in several slots, like the backs, is blended once and copied into each
+        card = np.asarray(card_img)
+        alpha = np.asarray(card_img.getchannel('A'))
+        height, width = alpha.shape
+        translucent = np.divmod(np.flatnonzero(alpha.ravel() < 255), width)
+        blended = blend_onto_transparent(card[translucent])
+        for slot in slots:
+            x, y = get_card_pos(slot)
+            region = self.pixels[y:y + height, x:x + width]
+            region[...] = card
+            region[translucent] = blended
+
+    def clear(self):
+        self.pixels.fill(0)
+
+    def to_image(self):
+        # The image shares the array's memory, so it has to be done with before the canvas is reused
+        return Image.fromarray(self.pixels, 'RGBA')
+
+
+# Canvases whose sheets are encoded, kept to fill the next ones. A fresh 100 MB array is faulted in page by page,
+# which stalls wherever the kernel compacts memory to back NumPy's huge pages, while clearing a used one is a memset
+_spare_canvases = []
+
+
+def get_sheet_canvas():
+    try:
+        canvas = _spare_canvases.pop()
+    except IndexError:
+        return SheetCanvas()
+    canvas.clear()
+    return canvas
+
+
+def release_sheet_canvas(canvas):
+    _spare_canvases.append(canvas)
+
+
+#
+# Encoding
+#
+
+def get_sheet_path(name_template, j, encoder=SheetEncoder()):
+    return DECKS_OUTPUT_DIR / Path(name_template.format(j=j)).with_suffix(SHEET_EXTENSIONS[encoder.format])
+
+
+def encode_sheet(img, encoder=SheetEncoder()):
+    buffer = BytesIO()
+    if encoder.format == 'png':
+        img.save(buffer, format='PNG', compress_level=encoder.compress_level)
+    elif encoder.format == 'jpeg':
+        # JPEG has no alpha, so empty slots on the last sheet come out black
+        img.convert('RGB').save(buffer, format='JPEG', quality=encoder.quality)
+    elif encoder.format == 'webp':
+        img.save(buffer, format='WEBP', quality=encoder.quality)
+    else:
+        raise ValueError(f'Unknown sheet format {encoder.format!r}, expected one of {", ".join(SHEET_EXTENSIONS)}')
+    return buffer.getvalue()
+
+
+def save_sheet(name_template, j, data, seconds, encoder=SheetEncoder()):
+    path = get_sheet_path(name_template, j, encoder)
+    path.write_bytes(data)
+    return {'sheet': path.name, 'bytes': len(data), 'seconds': round(seconds, 3)}
+
+
+def save_card_fronts_deck(j, card_fronts_deck, encoder=SheetEncoder()):
+    # Takes the sheet's canvas, which is free to be reused once this returns
+    start = time.perf_counter()
+    data = encode_sheet(card_fronts_deck.to_image(), encoder)
+    release_sheet_canvas(card_fronts_deck)
+    return save_sheet(CARD_FRONTS_DECK_IMG, j, data, time.perf_counter() - start, encoder)
 
-    i, j = 0, 0
-    df = read_cube()
 
-    card_fronts_deck_img = get_card_deck_base_img()
-    card_backs_deck_img = get_card_deck_base_img()
+@lru_cache(maxsize=4)
+def get_card_backs_deck_data(card_count, encoder=SheetEncoder()):
+    # Every slot of a back sheet holds the same card, so each layout (full sheet or the last partial one) is
+    # assembled and encoded once and the bytes reused for every sheet
+    start = time.perf_counter()
+    card_back_img = get_asset(CARD_ASSETS_DIR / 'card_backs' / 'standard.png', SHEET_CARD_SIZE)
+    card_backs_deck = get_sheet_canvas()
+    card_backs_deck.add_all(card_back_img, range(card_count))
+    data = encode_sheet(card_backs_deck.to_image(), encoder)
+    release_sheet_canvas(card_backs_deck)
+    return data, time.perf_counter() - start
 
-    for row_number, stats in tqdm(df.iterrows(), total=df.shape[0]):
-        if i == 70:
-            card_fronts_deck_img.save(DECKS_OUTPUT_DIR / CARD_FRONTS_DECK_IMG.format(j=j))
-            card_fronts_deck_img = get_card_deck_base_img()
-            card_backs_deck_img.save(DECKS_OUTPUT_DIR / CARD_BACKS_DECK_IMG.format(j=j))
-            card_backs_deck_img = get_card_deck_base_img()
-            i = 0
-            j += 1
 
-        pokemon_card_path = CARD_FRONTS_OUTPUT_DIR / f'{row_number}_{stats.pokedex_name}.png'
-        card_back_path = CARD_ASSETS_DIR / "card_backs" / 'standard.png'
-        card_pos = pos(i % 10, (i // 10) % 7)
+def save_card_backs_deck(j, card_count, encoder=SheetEncoder()):
+    # The time reported is the one off cost of encoding the layout, every sheet sharing it reuses the bytes
+    data, seconds = get_card_backs_deck_data(card_count, encoder)
+    return save_sheet(CARD_BACKS_DECK_IMG, j, data, seconds, encoder)
+
+
+def save_report(report):
+    report = sorted(report, key=lambda entry: entry['sheet'])
+    for entry in report:
+        print(f"{entry['sheet']}: {entry['bytes'] / 1e6:.1f} MB, encoded in {entry['seconds']:.2f}s")
+    with open(DECKS_OUTPUT_DIR / 'sheets_report.json', 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+#
+# Assembly
+#
+
+class SheetAssembler:
+    # Places card fronts onto their sheet as they arrive, in any order, and hands each sheet to a background
+    # thread to encode as soon as its last card is in. With a queue_size, put() hands cards to a thread of their own
+    # to place, and only blocks the caller once that many are waiting
+    def __init__(self, card_count, encoder=SheetEncoder(), queue_size=0):
+        self.card_count = card_count
+        self.encoder = encoder
+        self.report = []
+        self._sheets = {}
+        self._placer = None
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        DECKS_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+        # Encode the back sheets up front, while the first front sheet is filling, rather than alongside a later one
+        layouts = {self.sheet_card_count(j) for j in range(-(-card_count // CARDS_PER_SHEET))}
+        self._pending_write = self._writer.submit(
+            lambda: [get_card_backs_deck_data(count, encoder) for count in sorted(layouts)]
+        )
+        if queue_size:
+            self._placer = WorkerQueue(self.add, queue_size=queue_size)
+
+    def sheet_card_count(self, j):
+        return min(CARDS_PER_SHEET, self.card_count - j * CARDS_PER_SHEET)
+
+    def add(self, i, card_front_path, card_img=None):
+        j, slot = divmod(i, CARDS_PER_SHEET)
+        if j not in self._sheets:
+            self._sheets[j] = [get_sheet_canvas(), 0]
+        sheet = self._sheets[j]
+
+        if card_img is None:
+            card_img = get_img(card_front_path, SHEET_CARD_SIZE)
+        elif card_img.size != SHEET_CARD_SIZE:
+            card_img = card_img.resize(SHEET_CARD_SIZE)
+        sheet[0].add(card_img, slot)
+
+        sheet[1] += 1
+        if sheet[1] == self.sheet_card_count(j):
+            del self._sheets[j]
+            self._write(j, sheet[0])
+
+    def put(self, i, card_front_path, card_img=None):
+        if self._placer is None:
+            self.add(i, card_front_path, card_img)
+        else:
+            self._placer.put(i, card_front_path, card_img)
+
+    def _save(self, j, card_fronts_deck):
+        self.report.append(save_card_fronts_deck(j, card_fronts_deck, self.encoder))
+        self.report.append(save_card_backs_deck(j, self.sheet_card_count(j), self.encoder))
+
+    def _write(self, j, card_fronts_deck):
+        # Wait on the previous sheet first, so at most one finished sheet is held in memory while encoding
+        if self._pending_write is not None:
+            self._pending_write.result()
+        self._pending_write = self._writer.submit(self._save, j, card_fronts_deck)
+
+    def close(self, flush=True):
+        # With flush, sheets still missing cards are written as they are. Without, as when rendering failed, they're
+        # dropped rather than written over the complete sheets of the last build, and only the sheets that were
+        # finished get saved
+        if self._placer is not None:
+            try:
+                self._placer.close()
+            except BaseException:
+                self._writer.shutdown()
+                raise
+        for j in sorted(self._sheets):
+            if flush:
+                print(f'Sheet {j} is missing {self.sheet_card_count(j) - self._sheets[j][1]} cards')
+                self._write(j, self._sheets.pop(j)[0])
+            else:
+                release_sheet_canvas(self._sheets.pop(j)[0])
+        if self._pending_write is not None:
+            self._pending_write.result()
+        self._writer.shutdown()
+        save_report(self.report)
+
+
+def build_card_fronts_deck(job):
+    j, card_front_paths, encoder = job
+    timer = StageTimer()
+    card_fronts_deck = get_sheet_canvas()
+    # Decoding and resizing let go of the GIL, so the sheet's cards are loaded as a batch on a few threads and
+    # placed in order as they come in
+    with ThreadPoolExecutor(max_workers=SHEET_LOAD_THREADS) as loader:
+        card_imgs = loader.map(get_img, card_front_paths, repeat(SHEET_CARD_SIZE))
+        for slot in range(len(card_front_paths)):
+            with timer.stage('load_cards'):
+                card_img = next(card_imgs)
+            with timer.stage('paste'):
+                card_fronts_deck.add(card_img, slot)
+    with timer.stage('save'):
+        entry = save_card_fronts_deck(j, card_fronts_deck, encoder)
+    entry['stages'] = timer.stages
+    return entry
+
+
+def encode_card_backs_deck(job):
+    card_count, encoder = job
+    return card_count, get_card_backs_deck_data(card_count, encoder)
+
+
+def run(workers=None, encoder=SheetEncoder(), profile=False, wait=True):
+    print('Generating decks:')
+    DECKS_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    card_front_paths = [card_front_path(i, stats) for i, stats in enumerate(read_cube())]
+    # Sheets never share state, so each one is assembled and encoded independently
+    jobs = [
+        (j, card_front_paths[start:start + CARDS_PER_SHEET], encoder)
+        for j, start in enumerate(range(0, len(card_front_paths), CARDS_PER_SHEET))
+    ]
+    layouts = [(card_count, encoder) for card_count in sorted({len(job[1]) for job in jobs})]
+
+    report = []
+    workers = min(workers or os.cpu_count() or 1, max(len(jobs), 1))
+    if workers == 1:
+        card_backs = dict(map(encode_card_backs_deck, layouts))
+        report += tqdm(map(build_card_fronts_deck, jobs), total=len(jobs))
+    else:
+        with Pool(workers) as pool:
+            card_backs_result = pool.map_async(encode_card_backs_deck, layouts)
+            report += tqdm(pool.imap_unordered(build_card_fronts_deck, jobs), total=len(jobs))
+            card_backs = dict(card_backs_result.get())
 
-        card_fronts_deck_img = add_card_at_pos(card_fronts_deck_img, pokemon_card_path, card_pos)
-        card_backs_deck_img = add_card_at_pos(card_backs_deck_img, card_back_path, card_pos)
-        i += 1
+    for j, job_paths, _ in jobs:
+        data, seconds = card_backs[len(job_paths)]
+        report.append(save_sheet(CARD_BACKS_DECK_IMG, j, data, seconds, encoder))
+    save_report(report)
+    if profile:
+        sheets_report = ProfileReport('sheets')
+        for entry in report:
+            if 'stages' in entry:
+                sheets_report.add(entry['sheet'], entry['stages'])
+        sheets_report.save()
+        sheets_report.print_summary()
+    # Shown relative to the generator, like output/draft-0.25/decks, unless it was pointed somewhere else entirely
+    decks_dir = DECKS_OUTPUT_DIR
+    if decks_dir.is_relative_to(COMPONENT_DIR):
+        decks_dir = decks_dir.relative_to(COMPONENT_DIR).as_posix()
+    message = f'Now upload the images under {decks_dir} using the Modding -> Cloud Manager in Tabletop Simulator'
+    # Scripts and CI have nobody to press enter, and no terminal to read it from
+    if wait and sys.stdin.isatty():
+        input(f'{message}, then press enter to continue...')
     else:
-        card_fronts_deck_img.save(DECKS_OUTPUT_DIR / CARD_FRONTS_DECK_IMG.format(j=j))
-        card_backs_deck_img.save(DECKS_OUTPUT_DIR / CARD_BACKS_DECK_IMG.format(j=j))
-    input('Now upload the images under output/decks using the Modding -> Cloud Manager in Tabletop Simulator, then press enter to continue...')
+        print(message)
 
 
 if __name__ == '__main__':
-    run()
-    
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=None, help='number of sheets assembled at once (default: one per core)')
+    parser.add_argument('--profile', action='store_true', help='report the time each sheet spent in each stage')
+    parser.add_argument('--cprofile', action='store_true',
+                        help='run under cProfile in a single process and dump the stats to output/profile/generate_decks.pstats')
+    parser.add_argument('--no-wait', dest='wait', action='store_false', help="don't pause for the sheets to be uploaded")
+    add_encoder_arguments(parser)
+    args = parser.parse_args()
+    with cprofiled(PROFILE_OUTPUT_DIR / 'generate_decks.pstats' if args.cprofile else None):
+        run(workers=1 if args.cprofile else args.workers, encoder=get_encoder(args), profile=args.profile, wait=args.wait)
@@ -1,13 +1,22 @@
-from io import BytesIO
-
-import pandas as pd
-import requests
-from PIL import ImageDraw, Image, ImageChops
+import argparse
+import os
+from collections import namedtuple
+from functools import lru_cache, partial
+from itertools import product
+from multiprocessing import Pool
+
+from PIL import ImageDraw
 from tqdm import tqdm
-import urllib.request
 
+from asset_atlas import open_atlas, update_atlas
+from build_manifest import fingerprint, load_manifest, save_manifest
+from card_writer import CardWriter, remove_partial_writes
 from config import *
-from utils import xy, read_cube, get_img, text_font, title_font, wrapped_text
+from front_encoder import FrontEncoder, add_front_encoder_arguments, get_front_encoder
+from profiling import StageTimer, ProfileReport, counter_deltas, cprofiled
+from sprite_cache import get_sprite, sprite_counters
+from text_cache import draw_text, wrapped_text, text_layer_counters, text_layer_stats
+from utils import PX_PER_CM, xy, read_cube, get_asset, text_font, title_font, warm_caches, asset_cache, fonts
 
 
 #
@@ -16,14 +25,14 @@ from utils import xy, read_cube, get_img, text_font, title_font, wrapped_text
 
 
 def compose_base(stats):
-    base_img = get_img(CARD_ASSETS_DIR / 'card_bases' / 'standard.png', xy(16, 23))
+    base_img = get_asset(CARD_ASSETS_DIR / 'card_bases' / 'standard.png', xy(16, 23)).copy()
 
-    if not pd.isnull(stats.biome):
+    if stats.biome is not None:
         biome_name = stats.biome.lower()
-        biome_img = get_img(CARD_ASSETS_DIR / 'biomes' / f'{biome_name}.png', xy(16, 11))
+        biome_img = get_asset(CARD_ASSETS_DIR / 'biomes' / f'{biome_name}.png', xy(16, 11))
         base_img.alpha_composite(biome_img, xy(0, 2))
     else:
-        biome_img = get_img(CARD_ASSETS_DIR / 'biomes' / 'unknown.png', xy(16, 11))
+        biome_img = get_asset(CARD_ASSETS_DIR / 'biomes' / 'unknown.png', xy(16, 11))
         base_img.alpha_composite(biome_img, xy(0, 2))
     return base_img
 
@@ -33,7 +42,7 @@ def add_frame(img, stats):
     #img.paste(frame_img, xy(0.25, 0.25), frame_img)
     
     
-    frame_overlay = get_img(CARD_ASSETS_DIR / 'frame_overlays' / f'{stats.color.lower()}_frame.png', xy(16, 23))
+    frame_overlay = get_asset(CARD_ASSETS_DIR / 'frame_overlays' / f'{stats.color.lower()}_frame.png', xy(16, 23))
     img.paste(frame_overlay, xy(0, 0), frame_overlay)
 
 
@@ -55,49 +64,25 @@ def converted_pokedex_number(stats, i):
     return '-'.join(split_pokedex_number)
 
 
+def sprite_paths(stats):
+    # Sprites downloaded from the second mirror used to be saved under its zero padded name
+    return [CARD_ASSETS_DIR / 'pokemon' / f'{converted_pokedex_number(stats, i)}.png' for i in (0, 1)]
+
+
 def get_pokemon_img(stats):
     img_size = get_pokemon_img_size(stats)
-    img_name = converted_pokedex_number(stats, 0)
-    try:
-        pokemon_img = get_img(CARD_ASSETS_DIR / 'pokemon' / f'{img_name}.png', xy(img_size, img_size))
-    except (FileNotFoundError, AttributeError):
-        try:
-            download_image(f'{ART_FORM_URL}/{img_name}.png', img_name)        
-        except: 
-            try:
-                img_name = converted_pokedex_number(stats, 1)
-                download_image(f'{ART_FORM_URL2}/{img_name}.png',img_name)
-            except:
-                return
-        #response = requests.get(f'{ART_FORM_URL}/{img_name}.png')
-        pokemon_img = get_img(CARD_ASSETS_DIR / 'pokemon' / f'{img_name}.png', xy(img_size, img_size))
-        #pokemon_img = get_img(BytesIO(response.content), xy(img_size, img_size))
-        #pokemon_img.save(CARD_ASSETS_DIR / 'pokemon' / f'{img_name}.png')
-    return pokemon_img
-
-def download_image(url, filename):
-    r = requests.get(url)
-    try:
-        im = Image.open(BytesIO(r.content))
-    except:
-        raise ValueError('Couldnt find image')
-    im.save(CARD_ASSETS_DIR / 'pokemon' / f'{filename}.png')
-
-def trim_pokemon_image(img):    
-    bg = Image.new(img.mode, img.size, img.getpixel((0,0)))
-    diff = ImageChops.difference(img, bg)
-    diff = ImageChops.add(diff, diff, 2.0, -100)
-    bbox = diff.getbbox()
-    if bbox:
-        return img.crop(bbox)
+    for sprite_path in sprite_paths(stats):
+        if sprite_path.is_file():
+            return get_sprite(sprite_path, xy(img_size, img_size))
+
 
 def add_pokemon_img(img, stats):
+    # Sprites come back already trimmed, so placing one only needs its size
     pokemon_img = get_pokemon_img(stats)
-    if pd.isnull(pokemon_img): 
-        print("Couldn't find image for ", stats.pokedex_name)
+    if pokemon_img is None: 
+        print("Couldn't find image for ", stats.pokedex_name, '(run prefetch_sprites.py to download missing art)')
         return
-    pokemon_img = trim_pokemon_image(pokemon_img)
-    pokemon_img_pos = xy((16 - pokemon_img.width / 64) / 2, (15 - pokemon_img.height / 64) / 2)
+    pokemon_img_pos = xy((16 - pokemon_img.width / PX_PER_CM) / 2, (15 - pokemon_img.height / PX_PER_CM) / 2)
     img.paste(pokemon_img, pokemon_img_pos, pokemon_img)
 
 
@@ -110,19 +95,45 @@ def add_all_bases(img, stats):
 
 
 def add_stats_bases(img, stats):
-    if not pd.isnull(stats.cost):
-        health_base_img = get_img(CARD_ASSETS_DIR / 'stats_bases' / 'health.png', xy(2, 2))
+    if stats.cost is not None:
+        health_base_img = get_asset(CARD_ASSETS_DIR / 'stats_bases' / 'health.png', xy(2, 2))
         img.paste(health_base_img, xy(13.75, 0.25), health_base_img)
 
-    if not pd.isnull(stats.attack):
-        power_base_img = get_img(CARD_ASSETS_DIR / 'stats_bases' / 'power.png', xy(1.75, 1.75))
+    if stats.attack is not None:
+        power_base_img = get_asset(CARD_ASSETS_DIR / 'stats_bases' / 'power.png', xy(1.75, 1.75))
         img.paste(power_base_img, xy(14, 21.1), power_base_img)
 
-    if not pd.isnull(stats.health):
-        health_base_img = get_img(CARD_ASSETS_DIR / 'stats_bases' / 'power.png', xy(1.75, 1.75))
+    if stats.health is not None:
+        health_base_img = get_asset(CARD_ASSETS_DIR / 'stats_bases' / 'power.png', xy(1.75, 1.75))
         img.paste(health_base_img, xy(12, 21.1), health_base_img)
 
 
+#
+# Backgrounds
+#
+
+# The only fields the background layers read. Stats are reduced to whether they are there, so every card with
+# the same biome, frame colour and stat bases shares one background
+Background = namedtuple('Background', ['biome', 'color', 'cost', 'attack', 'health'])
+
+
+def background_key(stats):
+    return Background(
+        stats.biome.lower() if stats.biome is not None else None,
+        stats.color.lower(),
+        *(True if value is not None else None for value in (stats.cost, stats.attack, stats.health)),
+    )
+
+
+@lru_cache(maxsize=BACKGROUND_CACHE_SIZE)
+def get_background(background):
+    # The returned image is shared between cards, copy it before drawing on it
+    img = compose_base(background)
+    add_frame(img, background)
+    add_all_bases(img, background)
+    return img
+
+
 #
 # Icons
 #
@@ -132,13 +143,13 @@ def add_all_icons(img, stats):
 
 
 def get_types(stats):
-    return [type_ for type_ in (stats.type_1, stats.type_2) if not pd.isnull(type_)]
+    return [type_ for type_ in (stats.type_1, stats.type_2) if type_ is not None]
 
 
 def add_type_icons(img, stats):
     types = get_types(stats)
     for i, type_ in enumerate(types):
-        type_img = get_img(CARD_ASSETS_DIR / 'types' / f'{type_}.png', xy(1, 1))
+        type_img = get_asset(CARD_ASSETS_DIR / 'types' / f'{type_}.png', xy(1, 1))
         type_pos = xy(1.75 + i * 1.2, 21.9)
         img.paste(type_img, type_pos, type_img)
 
@@ -151,41 +162,35 @@ def add_text(img, stats):
     types = get_types(stats)
 
     # Pokémon Name
-    name_pos = xy(6.5, 1.5 - (0.5 if not pd.isnull(stats.tags) else 0))
-    name_font_size = text_font(44) if pd.isnull(stats.tags) else text_font(36)
-    d.text(name_pos, stats.pokedex_name, fill=DARK_COLOUR, font=name_font_size, anchor='mm')
+    name_pos = xy(6.5, 1.5 - (0.5 if stats.tags is not None else 0))
+    name_font_size = text_font(44) if stats.tags is None else text_font(36)
+    draw_text(d, name_pos, stats.pokedex_name, name_font_size, fill=DARK_COLOUR, anchor='mm')
   
     # Pokemon Tags
-    if not pd.isnull(stats.tags):
-        d.text(xy(6.5, 2), stats.tags, fill=DARK_COLOUR, font=text_font(20), anchor="mm")
+    if stats.tags is not None:
+        draw_text(d, xy(6.5, 2), stats.tags, text_font(20), fill=DARK_COLOUR, anchor="mm")
 
 
     # Pokémon Stats
-    if not pd.isnull(stats.cost):
+    if stats.cost is not None:
         wrapped_text(d, str(int(stats.cost)), title_font(40), boundaries=(4, 4), xy=xy(14.8, 1.2), fill=DARK_COLOUR, alignment="center", anchor='mm')
-    if not pd.isnull(stats.attack):
+    if stats.attack is not None:
         wrapped_text(d, str(int(stats.attack)), title_font(40), boundaries=(4, 4), xy=xy(14.9, 22), fill=DARK_COLOUR, alignment="center", anchor='mm')
-    if not pd.isnull(stats.health):
+    if stats.health is not None:
         wrapped_text(d, str(int(stats.health)), title_font(40), boundaries=(4, 4), xy=xy(12.9, 22), fill=DARK_COLOUR, alignment="center", anchor='mm')
 
     SetUpTextForFormats(d, GetFormat(stats), stats)
 
-    if not pd.isnull(stats.pokedex_number):
+    if stats.pokedex_number is not None:
         wrapped_text(d, str(stats.pokedex_number), text_font(20), boundaries=(2,1), xy=xy(.3,22.7), fill=DARK_COLOUR, alignment="left", anchor="ls")
 
-def GetFormat(stats):
-    format = 0
+# Fields that decide a card's format, in the order GetFormat reads them
+FORMAT_FIELDS = ('ability', 'ability_name', 'mode_1_ability', 'mode_1_name', 'mode_2_ability', 'mode_2_name', 'mode_3_ability', 'mode_3_name')
 
-    hasAbilityDesc          = not pd.isnull(stats.ability)
-    hasAbilityName          = not pd.isnull(stats.ability_name)    
-    hasModeOne              = not pd.isnull(stats.mode_1_ability)
-    hasModeOneName          = not pd.isnull(stats.mode_1_name)
-    hasModeTwo              = not pd.isnull(stats.mode_2_ability)
-    hasModeTwoName          = not pd.isnull(stats.mode_2_name)
-    hasModeThree            = not pd.isnull(stats.mode_3_ability)
-    hasModeThreeName        = not pd.isnull(stats.mode_3_name) 
 
-    hasNoModes              = not hasModeOne and not hasModeTwo and not hasModeThree
+def _format_for_fields(hasAbilityDesc, hasAbilityName, hasModeOne, hasModeOneName, hasModeTwo, hasModeTwoName, hasModeThree, hasModeThreeName):
+    format = 0
+
     hasTwoUnnamedModes      = hasModeOne and not hasModeOneName and hasModeTwo and not hasModeTwoName and not hasModeThree
     hasTwoNamedModes        = hasModeOne and hasModeOneName and hasModeTwo and hasModeTwoName and not hasModeThree
     hasThreeUnnamedModes    = hasModeOne and not hasModeOneName and hasModeTwo and not hasModeTwoName and hasModeThree and not hasModeThreeName
@@ -217,150 +222,325 @@ def GetFormat(stats):
     return format
 
 
+# Every combination of present and missing fields, resolved to its format once
+_FORMATS = {present: _format_for_fields(*present) for present in product((False, True), repeat=len(FORMAT_FIELDS))}
+
+
+def GetFormat(stats):
+    return _FORMATS[tuple(getattr(stats, field) is not None for field in FORMAT_FIELDS)]
 
-def SetUpTextForFormats(d, format, stats):
-    name_size = 32
-    text_size = 30
-    mode_name_size = 27
-    mode_text_size = 25
-
-    if format == 0:
-        if not pd.isnull(stats.ability):       
-            wrapped_text(d, stats.ability, text_font(text_size), fill=DARK_COLOUR, boundaries=(14,8), xy=(xy(8, 17.5)), alignment="center", anchor='mm')
-    if format == 1:
-        if not pd.isnull(stats.ability_name):
-            text = wrapped_text(d, stats.ability_name, title_font(name_size), fill=DARK_COLOUR, boundaries=(14, 2),  xy=xy(8, 13), alignment="center", anchor='ma')
-        if not pd.isnull(stats.ability):       
-            wrapped_text(d, stats.ability, text_font(text_size), fill=DARK_COLOUR, boundaries=(14,6), xy=(xy(8, 15)), alignment="center", anchor='ma')
-    if format == 2:
-        if not pd.isnull(stats.ability_name):
-            text = wrapped_text(d, stats.ability_name, title_font(name_size), fill=DARK_COLOUR, boundaries=(14, 2),  xy=xy(8, 13), alignment="center", anchor='ma')
-        if not pd.isnull(stats.ability):       
-            wrapped_text(d, stats.ability, text_font(text_size), fill=DARK_COLOUR, boundaries=(14,2), xy=(xy(8, 15.5)), alignment="center", anchor='ma')
-        if not pd.isnull(stats.mode_1_ability):
-            wrapped_text(d, stats.mode_1_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(14,2), xy = (xy(8, 18.5)), alignment="center", anchor="mm")
-        if not pd.isnull(stats.mode_2_ability):
-            wrapped_text(d, stats.mode_2_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(14,2), xy = (xy(8, 20.5)), alignment="center", anchor="mm")
-    if format == 3:
-        if not pd.isnull(stats.ability_name):
-            text = wrapped_text(d, stats.ability_name, title_font(name_size), fill=DARK_COLOUR, boundaries=(14, 2),  xy=xy(8, 13), alignment="center", anchor='ma')
-        if not pd.isnull(stats.ability):       
-            wrapped_text(d, stats.ability, text_font(text_size), fill=DARK_COLOUR, boundaries=(14,2), xy=(xy(8, 15.125)), alignment="center", anchor='ma')
-        if not pd.isnull(stats.mode_1_name):
-            wrapped_text(d, stats.mode_1_name, title_font(mode_name_size), fill=DARK_COLOUR, boundaries=(5,2), xy = (xy(1, 18.5)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_1_ability):
-            wrapped_text(d, stats.mode_1_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(9,2), xy = (xy(6, 18.5)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_2_name):
-            wrapped_text(d, stats.mode_2_name, title_font(mode_name_size), fill=DARK_COLOUR, boundaries=(5,2), xy = (xy(1, 20.5)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_2_ability):
-            wrapped_text(d, stats.mode_2_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(9,2), xy = (xy(6, 20.5)), alignment="left", anchor="lm")
-    if format == 4:
-        if not pd.isnull(stats.ability_name):
-            text = wrapped_text(d, stats.ability_name, title_font(name_size), fill=DARK_COLOUR, boundaries=(14, 1.5),  xy=xy(8, 13), alignment="center", anchor='ma')
-        if not pd.isnull(stats.ability):       
-            wrapped_text(d, stats.ability, text_font(text_size), fill=DARK_COLOUR, boundaries=(14,1.5), xy=(xy(8, 14.5)), alignment="center", anchor='ma')
-        if not pd.isnull(stats.mode_1_ability):
-            wrapped_text(d, stats.mode_1_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(14,1.5), xy = (xy(8, 17.25)), alignment="center", anchor="mm")
-        if not pd.isnull(stats.mode_2_ability):
-            wrapped_text(d, stats.mode_2_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(14,1.5), xy = (xy(8, 19)), alignment="center", anchor="mm")
-        if not pd.isnull(stats.mode_3_ability):
-            wrapped_text(d, stats.mode_3_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(14,1.5), xy = (xy(8, 20.75)), alignment="center", anchor="mm")
-    if format == 5:
-        if not pd.isnull(stats.ability_name):
-            text = wrapped_text(d, stats.ability_name, title_font(name_size), fill=DARK_COLOUR, boundaries=(14, 1.5),  xy=xy(8, 13), alignment="center", anchor='ma')
-        if not pd.isnull(stats.ability):       
-            wrapped_text(d, stats.ability, text_font(text_size), fill=DARK_COLOUR, boundaries=(14,1.1875), xy=(xy(8, 14.25)), alignment="center", anchor='ma')
-        if not pd.isnull(stats.mode_1_name):
-            wrapped_text(d, stats.mode_1_name, title_font(mode_name_size), fill=DARK_COLOUR, boundaries=(5,2), xy = (xy(1, 16.5)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_1_ability):
-            wrapped_text(d, stats.mode_1_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(9,2), xy = (xy(6, 16.5)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_2_name):
-            wrapped_text(d, stats.mode_2_name, title_font(mode_name_size), fill=DARK_COLOUR, boundaries=(5,2), xy = (xy(1, 18.5)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_2_ability):
-            wrapped_text(d, stats.mode_2_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(9,2), xy = (xy(6, 18.5)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_3_name):
-            wrapped_text(d, stats.mode_3_name, title_font(mode_name_size), fill=DARK_COLOUR, boundaries=(5,2), xy = (xy(1, 20.5)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_3_ability):
-            wrapped_text(d, stats.mode_3_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(9,2), xy = (xy(6, 20.5)), alignment="left", anchor="lm")
-    if format == 6:
-        if not pd.isnull(stats.ability):       
-            wrapped_text(d, stats.ability, text_font(text_size), fill=DARK_COLOUR, boundaries=(14,2), xy=(xy(8, 13)), alignment="center", anchor='ma')
-        if not pd.isnull(stats.mode_1_ability):
-            wrapped_text(d, stats.mode_1_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(14,3), xy = (xy(8, 16.5)), alignment="center", anchor="mm")
-        if not pd.isnull(stats.mode_2_ability):
-            wrapped_text(d, stats.mode_2_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(14,3), xy = (xy(8, 19.5)), alignment="center", anchor="mm")
-    if format == 7:
-        if not pd.isnull(stats.ability):       
-            wrapped_text(d, stats.ability, text_font(text_size), fill=DARK_COLOUR, boundaries=(14,2.5), xy=(xy(8, 14)), alignment="center", anchor='ma')
-        if not pd.isnull(stats.mode_1_name):
-            wrapped_text(d, stats.mode_1_name, title_font(mode_name_size), fill=DARK_COLOUR, boundaries=(5,2.5), xy = (xy(1, 17)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_1_ability):
-            wrapped_text(d, stats.mode_1_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(9,2.5), xy = (xy(6, 17)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_2_name):
-            wrapped_text(d, stats.mode_2_name, title_font(mode_name_size), fill=DARK_COLOUR, boundaries=(5,2.5), xy = (xy(1, 20)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_2_ability):
-            wrapped_text(d, stats.mode_2_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(9,2.5), xy = (xy(6, 20)), alignment="left", anchor="lm")
-    if format == 8:
-        if not pd.isnull(stats.ability):       
-            wrapped_text(d, stats.ability, text_font(text_size), fill=DARK_COLOUR, boundaries=(14,2), xy=(xy(8, 12.5)), alignment="center", anchor='ma')
-        if not pd.isnull(stats.mode_1_ability):
-            wrapped_text(d, stats.mode_1_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(14,2), xy = (xy(8, 15.75)), alignment="center", anchor="mm")
-        if not pd.isnull(stats.mode_2_ability):
-            wrapped_text(d, stats.mode_2_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(14,2), xy = (xy(8, 18)), alignment="center", anchor="mm")
-        if not pd.isnull(stats.mode_3_ability):
-            wrapped_text(d, stats.mode_3_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(14,2), xy = (xy(8, 20.25)), alignment="center", anchor="mm")
-    if format == 9:
-        if not pd.isnull(stats.ability):       
-            wrapped_text(d, stats.ability, text_font(text_size), fill=DARK_COLOUR, boundaries=(14,2), xy=(xy(8, 12.5)), alignment="center", anchor='ma')
-        if not pd.isnull(stats.mode_1_name):
-            wrapped_text(d, stats.mode_1_name, title_font(mode_name_size), fill=DARK_COLOUR, boundaries=(5,2), xy = (xy(1, 15.75)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_1_ability):
-            wrapped_text(d, stats.mode_1_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(9,2), xy = (xy(6, 15.75)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_2_name):
-            wrapped_text(d, stats.mode_2_name, title_font(mode_name_size), fill=DARK_COLOUR, boundaries=(5,2), xy = (xy(1, 18)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_2_ability):
-            wrapped_text(d, stats.mode_2_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(9,2), xy = (xy(6, 18)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_3_name):
-            wrapped_text(d, stats.mode_3_name, title_font(mode_name_size), fill=DARK_COLOUR, boundaries=(5,2), xy = (xy(1, 20.5)), alignment="left", anchor="lm")
-        if not pd.isnull(stats.mode_3_ability):
-            wrapped_text(d, stats.mode_3_ability, text_font(mode_text_size), fill=DARK_COLOUR, boundaries=(9,2), xy = (xy(6, 20.5)), alignment="left", anchor="lm")
-    if format == 10:
-        if not pd.isnull(stats.ability_name):       
-            wrapped_text(d, stats.ability_name, title_font(name_size), fill=DARK_COLOUR, boundaries=(14,8), xy=(xy(8, 17.5)), alignment="center", anchor='mm')
-    return
 
 #
-# Entry
+# Text Layouts
 #
 
+NAME = ('title', 32)
+TEXT = ('text', 30)
+MODE_NAME = ('title', 27)
+MODE_TEXT = ('text', 25)
+
+# The text slots of each format, drawn in order: (field, font, boundaries, position, alignment, anchor), with
+# boundaries and positions in cm
+FORMAT_LAYOUTS = {
+    0: [
+        ('ability', TEXT, (14, 8), (8, 17.5), 'center', 'mm'),
+    ],
+    1: [
+        ('ability_name', NAME, (14, 2), (8, 13), 'center', 'ma'),
+        ('ability', TEXT, (14, 6), (8, 15), 'center', 'ma'),
+    ],
+    2: [
+        ('ability_name', NAME, (14, 2), (8, 13), 'center', 'ma'),
+        ('ability', TEXT, (14, 2), (8, 15.5), 'center', 'ma'),
+        ('mode_1_ability', MODE_TEXT, (14, 2), (8, 18.5), 'center', 'mm'),
+        ('mode_2_ability', MODE_TEXT, (14, 2), (8, 20.5), 'center', 'mm'),
+    ],
+    3: [
+        ('ability_name', NAME, (14, 2), (8, 13), 'center', 'ma'),
+        ('ability', TEXT, (14, 2), (8, 15.125), 'center', 'ma'),
+        ('mode_1_name', MODE_NAME, (5, 2), (1, 18.5), 'left', 'lm'),
+        ('mode_1_ability', MODE_TEXT, (9, 2), (6, 18.5), 'left', 'lm'),
+        ('mode_2_name', MODE_NAME, (5, 2), (1, 20.5), 'left', 'lm'),
+        ('mode_2_ability', MODE_TEXT, (9, 2), (6, 20.5), 'left', 'lm'),
+    ],
+    4: [
+        ('ability_name', NAME, (14, 1.5), (8, 13), 'center', 'ma'),
+        ('ability', TEXT, (14, 1.5), (8, 14.5), 'center', 'ma'),
+        ('mode_1_ability', MODE_TEXT, (14, 1.5), (8, 17.25), 'center', 'mm'),
+        ('mode_2_ability', MODE_TEXT, (14, 1.5), (8, 19), 'center', 'mm'),
+        ('mode_3_ability', MODE_TEXT, (14, 1.5), (8, 20.75), 'center', 'mm'),
+    ],
+    5: [
+        ('ability_name', NAME, (14, 1.5), (8, 13), 'center', 'ma'),
+        ('ability', TEXT, (14, 1.1875), (8, 14.25), 'center', 'ma'),
+        ('mode_1_name', MODE_NAME, (5, 2), (1, 16.5), 'left', 'lm'),
+        ('mode_1_ability', MODE_TEXT, (9, 2), (6, 16.5), 'left', 'lm'),
+        ('mode_2_name', MODE_NAME, (5, 2), (1, 18.5), 'left', 'lm'),
+        ('mode_2_ability', MODE_TEXT, (9, 2), (6, 18.5), 'left', 'lm'),
+        ('mode_3_name', MODE_NAME, (5, 2), (1, 20.5), 'left', 'lm'),
+        ('mode_3_ability', MODE_TEXT, (9, 2), (6, 20.5), 'left', 'lm'),
+    ],
+    6: [
+        ('ability', TEXT, (14, 2), (8, 13), 'center', 'ma'),
+        ('mode_1_ability', MODE_TEXT, (14, 3), (8, 16.5), 'center', 'mm'),
+        ('mode_2_ability', MODE_TEXT, (14, 3), (8, 19.5), 'center', 'mm'),
+    ],
+    7: [
+        ('ability', TEXT, (14, 2.5), (8, 14), 'center', 'ma'),
+        ('mode_1_name', MODE_NAME, (5, 2.5), (1, 17), 'left', 'lm'),
+        ('mode_1_ability', MODE_TEXT, (9, 2.5), (6, 17), 'left', 'lm'),
+        ('mode_2_name', MODE_NAME, (5, 2.5), (1, 20), 'left', 'lm'),
+        ('mode_2_ability', MODE_TEXT, (9, 2.5), (6, 20), 'left', 'lm'),
+    ],
+    8: [
+        ('ability', TEXT, (14, 2), (8, 12.5), 'center', 'ma'),
+        ('mode_1_ability', MODE_TEXT, (14, 2), (8, 15.75), 'center', 'mm'),
+        ('mode_2_ability', MODE_TEXT, (14, 2), (8, 18), 'center', 'mm'),
+        ('mode_3_ability', MODE_TEXT, (14, 2), (8, 20.25), 'center', 'mm'),
+    ],
+    9: [
+        ('ability', TEXT, (14, 2), (8, 12.5), 'center', 'ma'),
+        ('mode_1_name', MODE_NAME, (5, 2), (1, 15.75), 'left', 'lm'),
+        ('mode_1_ability', MODE_TEXT, (9, 2), (6, 15.75), 'left', 'lm'),
+        ('mode_2_name', MODE_NAME, (5, 2), (1, 18), 'left', 'lm'),
+        ('mode_2_ability', MODE_TEXT, (9, 2), (6, 18), 'left', 'lm'),
+        ('mode_3_name', MODE_NAME, (5, 2), (1, 20.5), 'left', 'lm'),
+        ('mode_3_ability', MODE_TEXT, (9, 2), (6, 20.5), 'left', 'lm'),
+    ],
+    10: [
+        ('ability_name', NAME, (14, 8), (8, 17.5), 'center', 'mm'),
+    ],
+}
+
+TextSlot = namedtuple('TextSlot', ['field', 'font', 'boundaries', 'xy', 'alignment', 'anchor'])
+
+
+@lru_cache(maxsize=None)
+def compile_layouts():
+    # Resolve every slot's font and pixel position once, so drawing a card's text is only a walk over its slots
+    font_getters = {'text': text_font, 'title': title_font}
+    return {
+        format: tuple(
+            TextSlot(field, font_getters[font_name](font_size), boundaries, xy(*position), alignment, anchor)
+            for field, (font_name, font_size), boundaries, position, alignment, anchor in slots
+        )
+        for format, slots in FORMAT_LAYOUTS.items()
+    }
 
-def run(overwrite=False):
-    print('Generating card fronts:')
-    CARD_FRONTS_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
-    df = read_cube()
-    for i, stats in tqdm(df.iterrows(), total=df.shape[0]):
-        output_path = CARD_FRONTS_OUTPUT_DIR / f'{i}_{stats.pokedex_name.lower()}.png'
-        if output_path.is_file() and not overwrite:
-            continue
+def SetUpTextForFormats(d, format, stats):
+    for slot in compile_layouts()[format]:
+        text = getattr(stats, slot.field)
+        if text is not None:
+            wrapped_text(d, text, slot.font, fill=DARK_COLOUR, boundaries=slot.boundaries, xy=slot.xy,
+                         alignment=slot.alignment, anchor=slot.anchor)
+
 
-        img = compose_base(stats)
+#
+# Entry
+#
 
-        # img = Image.new('RGBA', xy(16, 28))
-        add_frame(img, stats)
-        add_pokemon_img(img, stats)
 
-        add_all_bases(img, stats)
+def card_front_path(i, stats, output_dir=None):
+    return (output_dir or CARD_FRONTS_OUTPUT_DIR) / f'{i}_{stats.pokedex_name.lower()}.png'
+
+
+def card_input_paths(stats):
+    paths = [
+        CARD_ASSETS_DIR / 'card_bases' / 'standard.png',
+        CARD_ASSETS_DIR / 'biomes' / (f'{stats.biome.lower()}.png' if stats.biome is not None else 'unknown.png'),
+        CARD_ASSETS_DIR / 'frame_overlays' / f'{stats.color.lower()}_frame.png',
+        *sprite_paths(stats),
+        BARLOW_PATH,
+        ORIENTAL_PATH,
+    ]
+    if stats.cost is not None:
+        paths.append(CARD_ASSETS_DIR / 'stats_bases' / 'health.png')
+    if stats.attack is not None or stats.health is not None:
+        paths.append(CARD_ASSETS_DIR / 'stats_bases' / 'power.png')
+    paths += [CARD_ASSETS_DIR / 'types' / f'{type_}.png' for type_ in get_types(stats)]
+    # Changes to the rendering code itself invalidate every card
+    paths += [COMPONENT_DIR / module for module in ('config.py', 'utils.py', 'asset_atlas.py', 'sprite_cache.py', 'text_cache.py', 'card_writer.py', 'front_encoder.py', 'generate_pokemon.py')]
+    return paths
+
+
+def card_fingerprint(i, stats):
+    fields = dict(stats.items())
+    fields['output'] = card_front_path(i, stats).name
+    return fingerprint(fields, card_input_paths(stats))
+
+
+def cache_counters():
+    backgrounds = get_background.cache_info()
+    return {
+        'asset_hits': asset_cache.hits,
+        'asset_misses': asset_cache.misses,
+        'asset_atlas_hits': asset_cache.atlas_hits,
+        'background_hits': backgrounds.hits,
+        'background_misses': backgrounds.misses,
+        'font_hits': fonts.hits,
+        'font_loads': fonts.loads,
+        'sprite_hits': sprite_counters['hits'],
+        'sprite_misses': sprite_counters['misses'],
+        'text_layer_hits': text_layer_counters['hits'],
+        'text_layer_disk_hits': text_layer_counters['disk_hits'],
+        'text_layer_misses': text_layer_counters['misses'],
+    }
+
+
+def text_layer_summary(counters):
+    stats = text_layer_stats({name: counters.get(f'text_layer_{name}', 0) for name in text_layer_counters})
+    return (f"Text layers: {stats['hit_ratio']:.0%} reused, {stats['hits']} from memory, {stats['disk_hits']} from disk, "
+            f"{stats['misses']} drawn")
+
+
+def draw_card(stats, timer=None):
+    timer = timer or StageTimer()
+
+    # The sprite never reaches the stat bases, so they can be baked into the background underneath it
+    with timer.stage('background'):
+        img = get_background(background_key(stats)).copy()
+
+    # img = Image.new('RGBA', xy(16, 28))
+    with timer.stage('add_pokemon_img'):
+        add_pokemon_img(img, stats)
 
+    with timer.stage('add_icons'):
         add_all_icons(img, stats)
 
+    with timer.stage('add_text'):
         add_text(img, stats)
-        # add_move(img, stats)
-        # add_emblem(img)
+    # add_move(img, stats)
+    # add_emblem(img)
+
+    # base_img.paste(img, xy(0, 0), img)
+    return img
+
+
+def render_card(i, stats, card_size=None, writer=None, output_dir=None):
+    output_path = card_front_path(i, stats, output_dir)
+    timer = StageTimer()
+    counters = cache_counters()
+
+    img = draw_card(stats, timer)
+    if writer is not None:
+        writer.put(img, output_path, timer)
+    # Scaled down copies are handed back for deck sheets, which is far cheaper to send between processes
+    with timer.stage('resize'):
+        card_img = img.resize(card_size) if card_size else None
+    # Timings and cache counters travel back with the card, since workers can't share a report. The save stage is
+    # only filled in once the writer has the card on disk
+    return i, output_path, card_img, (timer.stages, counter_deltas(counters, cache_counters()))
+
+
+def _render_batch(rows, card_size=None, save=True, output_dir=None, encoder=FrontEncoder()):
+    # Draws the rows one after another while a writer saves the ones already drawn, and hands them back once every
+    # file is in place, so a card is never recorded as rendered before it's whole on disk
+    writer = CardWriter(encoder) if save else None
+    try:
+        return [render_card(i, stats, card_size, writer, output_dir) for i, stats in rows]
+    finally:
+        if writer is not None:
+            writer.close()
+
 
-        # base_img.paste(img, xy(0, 0), img)
-        img.save(output_path)
+def _init_worker():
+    # Every worker process keeps its own caches, so load them once up front rather than on its first card. Assets
+    # come from the atlas, shared between all the workers, rather than each decoding its own
+    if USE_ASSET_ATLAS:
+        asset_cache.atlas = open_atlas()
+    warm_caches()
+    compile_layouts()
+
+
+def _render_rows(rows, workers=None, card_size=None, save=True, output_dir=None, encoder=FrontEncoder()):
+    if not rows:
+        return
+    render_batch = partial(_render_batch, card_size=card_size, save=save, output_dir=output_dir, encoder=encoder)
+    workers = min(workers or os.cpu_count() or 1, len(rows))
+    batch_size = max(1, min(CARD_BATCH_SIZE, len(rows) // (workers * 8)))
+    batches = [rows[start:start + batch_size] for start in range(0, len(rows), batch_size)]
+    if USE_ASSET_ATLAS:
+        update_atlas()
+    if save:
+        remove_partial_writes(output_dir or CARD_FRONTS_OUTPUT_DIR)
+    if workers == 1:
+        _init_worker()
+        for batch in map(render_batch, batches):
+            yield from batch
+        return
+
+    with Pool(workers, initializer=_init_worker) as pool:
+        for batch in pool.imap_unordered(render_batch, batches):
+            yield from batch
+
+
+def _remove_stale_outputs(manifest, fingerprints):
+    stale = [name for name in manifest if name not in fingerprints]
+    for name in stale:
+        (CARD_FRONTS_OUTPUT_DIR / name).unlink(missing_ok=True)
+        del manifest[name]
+    return len(stale)
+
+
+def run(overwrite=False, workers=None, incremental=False, on_card=None, card_size=None, profile=False, cube=None, save=True,
+        encoder=FrontEncoder()):
+    # on_card(i, output_path, card_img) is called for every card in the cube, card_img being the freshly rendered
+    # card at card_size, or None for cards that were already up to date on disk. With profile, the time each card
+    # spent in each stage is written to output/profile/card_fronts.json and .csv. Without save, every card is
+    # rendered and only handed to on_card, nothing is written and the manifest is left alone
+    print('Generating card fronts:')
+    CARD_FRONTS_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    cube = read_cube() if cube is None else cube
+    manifest = load_manifest(CARD_FRONTS_MANIFEST)
+    fingerprints = {}
+    rows = []
+    for i, stats in enumerate(cube):
+        output_path = card_front_path(i, stats)
+        fingerprints[output_path.name] = card_fingerprint(i, stats)
+        up_to_date = save and output_path.is_file() and (
+            manifest.get(output_path.name) == fingerprints[output_path.name] if incremental else not overwrite
+        )
+        if not up_to_date:
+            rows.append((i, stats))
+        elif on_card:
+            on_card(i, output_path, None)
+
+    if incremental and save:
+        removed = _remove_stale_outputs(manifest, fingerprints)
+        print(f'{len(rows)} of {len(cube)} cards changed, {removed} stale cards removed')
+
+    report = ProfileReport('card_fronts')
+    try:
+        for i, output_path, card_img, (stages, counters) in tqdm(_render_rows(rows, workers, card_size, save, encoder=encoder), total=len(rows)):
+            if save:
+                manifest[output_path.name] = fingerprints[output_path.name]
+            report.add(output_path.name, stages, counters)
+            if on_card:
+                on_card(i, output_path, card_img)
+    finally:
+        # Cards finished before an interruption are recorded, so they aren't rendered again
+        if save:
+            save_manifest(CARD_FRONTS_MANIFEST, manifest)
+
+    if profile:
+        report.save()
+        report.print_summary()
+        print(text_layer_summary(report.counters))
+    return report
 
 
 if __name__ == '__main__':
-    run(overwrite=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=None, help='number of render processes (default: one per core)')
+    parser.add_argument('--incremental', action='store_true', help='only render cards whose inputs changed since the last build')
+    parser.add_argument('--profile', action='store_true', help='report the time each card spent in each stage, and cache hits')
+    parser.add_argument('--cprofile', action='store_true',
+                        help='run under cProfile in a single process and dump the stats to output/profile/generate_pokemon.pstats')
+    add_front_encoder_arguments(parser)
+    args = parser.parse_args()
+    with cprofiled(PROFILE_OUTPUT_DIR / 'generate_pokemon.pstats' if args.cprofile else None):
+        # Pool workers aren't seen by cProfile, so profiled runs render in this process
+        run(overwrite=True, workers=1 if args.cprofile else args.workers, incremental=args.incremental, profile=args.profile,
+            encoder=get_front_encoder(args))
@@ -0,0 +1,58 @@
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from queue import Queue
+from threading import Thread
+
+
+# Kept free of PIL and the cube, so the stages that only write files don't pay to import them
+
+
+@contextmanager
+def atomic_write(path):
+    # Yields a temporary path next to path to write to, renamed over path once the block is done, so path is only
+    # ever missing or whole. Every process writes its own temporary file and the last rename wins. If the block or
+    # the rename fails the temporary file is removed, and path is left as it was
+    path = Path(path)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+class WorkerQueue:
+    # Calls handle(*job) for each job put, on background threads. put() only blocks once queue_size jobs are waiting
+    # (never with 0). The first error handling a job is raised by the next put() and by close()
+    def __init__(self, handle, threads=1, queue_size=0):
+        self._handle = handle
+        self._error = None
+        self._queue = Queue(maxsize=queue_size)
+        self._threads = [Thread(target=self._work, daemon=True) for _ in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, *job):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(job)
+
+    def _work(self):
+        while (job := self._queue.get()) is not None:
+            # After a failure keep draining, so put() never blocks on a queue nobody reads
+            if self._error is None:
+                try:
+                    self._handle(*job)
+                except BaseException as e:
+                    self._error = e
+
+    def close(self):
+        # Returns once every job put is handled
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
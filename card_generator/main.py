@@ -1,13 +1,216 @@
-import generate_pokemon
-import generate_decks
-import generate_deck_object
+import time
 
+STARTED = time.perf_counter()
 
-def run_all(overwrite=False):
-    generate_pokemon.run(overwrite)
-    #generate_decks.run()
-    #generate_deck_object.run()
+import argparse
+import importlib
+import os
+import sys
+
+import config
+from config import *
+from front_encoder import FrontEncoder, add_front_encoder_arguments, get_front_encoder
+from sheet_encoder import SheetEncoder, add_encoder_arguments, get_encoder
+
+
+# Stages are imported by the command that runs them, so no command pays for the dependencies of the others
+
+
+def run_all(overwrite=False, workers=None, incremental=False, prefetch=True, sheets=False, sheet_encoder=None, profile=False,
+            save_fronts=True, sheet_urls_path=None, front_encoder=FrontEncoder()):
+    # With sheets, the whole build is one pass over the cube: render workers hand each card back in memory, a
+    # thread places it on its sheet through a bounded queue and another encodes finished sheets, and the deck
+    # object is written from the same cube. Without save_fronts the individual fronts never touch the disk
+    import generate_pokemon
+    from cube import read_cube
+
+    if prefetch:
+        import prefetch_sprites
+        prefetch_sprites.run()
+    cube = read_cube()
+    if sheets:
+        import generate_decks
+        assembler = generate_decks.SheetAssembler(len(cube), sheet_encoder or SheetEncoder(), queue_size=PIPELINE_QUEUE_SIZE)
+        try:
+            generate_pokemon.run(overwrite, workers, incremental, on_card=assembler.put, card_size=generate_decks.SHEET_CARD_SIZE,
+                                 profile=profile, cube=cube, save=save_fronts, encoder=front_encoder)
+        except BaseException:
+            # A sheet missing the cards that never came would replace a complete one from the last build
+            assembler.close(flush=False)
+            raise
+        assembler.close()
+    else:
+        generate_pokemon.run(overwrite, workers, incremental, profile=profile, cube=cube, encoder=front_encoder)
+    if sheet_urls_path:
+        import generate_deck_object
+        generate_deck_object.write_deck_object(cube, generate_deck_object.load_sheet_urls(sheet_urls_path))
+
+
+def run_render(args):
+    if args.shard or args.rows:
+        run_shard(args)
+        return
+    import generate_pokemon
+    report_startup(args)
+    generate_pokemon.run(overwrite=True, workers=args.workers, incremental=not args.full, profile=args.profile,
+                         encoder=get_front_encoder(args))
+
+
+def run_shard(args):
+    import shards
+    from cube import read_cube
+    card_count = len(read_cube())
+    try:
+        if args.shard:
+            shard = shards.parse_shard(args.shard)
+            indices = shards.shard_rows(card_count, *shard)
+        else:
+            shard = None
+            indices = shards.parse_rows(args.rows, card_count)
+    except ValueError as e:
+        raise SystemExit(e)
+    label = shards.shard_label(shard, args.rows)
+    report_startup(args)
+    shards.render_shard(indices, args.shard_dir, label, workers=args.workers, profile=args.profile,
+                        encoder=get_front_encoder(args))
+
+
+def run_merge(args):
+    import shards
+    report_startup(args)
+    try:
+        shards.merge_shards(args.shard_dirs, partial=args.partial)
+    except ValueError as e:
+        raise SystemExit(e)
+
+
+def run_sheets(args):
+    import generate_decks
+    report_startup(args)
+    generate_decks.run(workers=args.workers, encoder=get_encoder(args), profile=args.profile, wait=args.wait)
+
+
+def run_deck_object(args):
+    import generate_deck_object
+    report_startup(args)
+    generate_deck_object.run(sheet_urls_path=args.urls, profile=args.profile)
+
+
+def run_prefetch(args):
+    import prefetch_sprites
+    report_startup(args)
+    mirrors = prefetch_sprites.get_mirrors(args.mirror) if args.mirror else SPRITE_MIRRORS
+    prefetch_sprites.run(mirrors=mirrors, concurrency=args.concurrency, timeout=args.timeout)
+
+
+def run_pipeline(args):
+    import generate_pokemon
+    if not args.offline:
+        import prefetch_sprites
+    if args.sheets:
+        import generate_decks
+    if args.urls:
+        import generate_deck_object
+    if args.no_fronts and not args.sheets:
+        raise SystemExit('--no-fronts only makes sense with --sheets, the fronts would go nowhere')
+    report_startup(args)
+    run_all(overwrite=True, workers=args.workers, incremental=not args.full, prefetch=not args.offline, sheets=args.sheets,
+            sheet_encoder=get_encoder(args), profile=args.profile, save_fronts=not args.no_fronts, sheet_urls_path=args.urls,
+            front_encoder=get_front_encoder(args))
+
+
+def use_render_scale(scale):
+    # config works out the output directories from the scale, and the stages only import it once they run. The
+    # environment carries the scale on to render workers, which may import everything afresh
+    os.environ['CARD_RENDER_SCALE'] = repr(scale)
+    importlib.reload(config)
+
+
+def add_scale_arguments(parser):
+    scale = parser.add_mutually_exclusive_group()
+    scale.add_argument('--draft', dest='scale', action='store_const', const=DRAFT_SCALE,
+                       help=f'draw at {DRAFT_SCALE:g}x full size into output/draft-{DRAFT_SCALE:g}, to proofread text and layouts quickly')
+    scale.add_argument('--scale', type=float, default=None,
+                       help='draw at this fraction of full size, anything but 1 into an output/draft-<scale> directory of its own')
+
+
+def report_startup(args):
+    # Everything up to here is interpreter and import time, before the stage does any work
+    print(f'{args.command} started in {(time.perf_counter() - STARTED) * 1000:.0f} ms')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Build the card fronts, deck sheets and Tabletop Simulator deck object. '
+                                                 'Without a command, prefetches missing sprites and renders the card fronts.')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    pipeline = commands.add_parser('all', help='prefetch missing sprites and render the card fronts (the default)')
+    pipeline.add_argument('--workers', type=int, default=None, help='number of render processes (default: one per core)')
+    pipeline.add_argument('--full', action='store_true', help='render every card instead of only the ones whose inputs changed')
+    pipeline.add_argument('--no-prefetch', '--offline', dest='offline', action='store_true', help='skip downloading missing sprites')
+    pipeline.add_argument('--sheets', action='store_true', help='assemble the deck sheets while rendering')
+    pipeline.add_argument('--no-fronts', action='store_true', help='with --sheets, only write the sheets and not every card front')
+    pipeline.add_argument('--urls', default=None,
+                          help='JSON file mapping each sheet number to its FaceURL and BackURL, to write the deck object in the same pass')
+    pipeline.add_argument('--profile', action='store_true', help='report the time each card spent in each stage, and cache hits')
+    add_scale_arguments(pipeline)
+    add_front_encoder_arguments(pipeline)
+    add_encoder_arguments(pipeline)
+    pipeline.set_defaults(handler=run_pipeline)
+
+    render = commands.add_parser('render', help='render the card fronts')
+    render.add_argument('--workers', type=int, default=None, help='number of render processes (default: one per core)')
+    render.add_argument('--full', action='store_true', help='render every card instead of only the ones whose inputs changed')
+    render.add_argument('--profile', action='store_true', help='report the time each card spent in each stage, and cache hits')
+    add_scale_arguments(render)
+    add_front_encoder_arguments(render)
+    shard = render.add_mutually_exclusive_group()
+    shard.add_argument('--shard', default=None, metavar='K/N',
+                       help='render only the Kth of N even slices of the cube, into a shard directory to merge later')
+    shard.add_argument('--rows', default=None, help='render only these cube rows, like 0-139,280-349, into a shard directory')
+    render.add_argument('--shard-dir', type=Path, default=None,
+                        help='where to render the shard (default: output/shards/K-of-N, or rows-... for --rows)')
+    render.set_defaults(handler=run_render)
+
+    sheets = commands.add_parser('sheets', help='assemble the deck sheets from the rendered card fronts')
+    sheets.add_argument('--workers', type=int, default=None, help='number of sheets assembled at once (default: one per core)')
+    sheets.add_argument('--profile', action='store_true', help='report the time each sheet spent in each stage')
+    sheets.add_argument('--no-wait', dest='wait', action='store_false', help="don't pause for the sheets to be uploaded")
+    add_scale_arguments(sheets)
+    add_encoder_arguments(sheets)
+    sheets.set_defaults(handler=run_sheets)
+
+    merge = commands.add_parser('merge', help='check rendered shards and combine their cards into the card fronts directory')
+    merge.add_argument('shard_dirs', nargs='*', type=Path, help='shard directories to merge (default: every one under output/shards)')
+    merge.add_argument('--partial', action='store_true',
+                       help="merge even if the shards don't cover the whole cube, keeping the fronts already there")
+    add_scale_arguments(merge)
+    merge.set_defaults(handler=run_merge)
+
+    deck_object = commands.add_parser('deck-object', help='write the Tabletop Simulator deck object')
+    deck_object.add_argument('--urls', default=None,
+                             help='JSON file mapping each sheet number to its FaceURL and BackURL, instead of asking for them')
+    deck_object.add_argument('--profile', action='store_true', help='report the time spent loading the cube and writing cards')
+    deck_object.set_defaults(handler=run_deck_object)
+
+    prefetch = commands.add_parser('prefetch', help='download missing sprites')
+    prefetch.add_argument('--concurrency', type=int, default=PREFETCH_CONCURRENCY, help='number of downloads in flight at once')
+    prefetch.add_argument('--timeout', type=float, default=PREFETCH_TIMEOUT, help='seconds to wait on each request')
+    prefetch.add_argument('--mirror', action='append', default=None,
+                          help='base URL to download sprites from, tried in order (default: the configured art mirrors)')
+    prefetch.set_defaults(handler=run_prefetch)
+    return parser
 
 
 if __name__ == '__main__':
-    run_all(overwrite=True)
\ No newline at end of file
+    argv = sys.argv[1:]
+    # Plain `main.py [options]` still runs the whole pipeline
+    if not argv or (argv[0].startswith('-') and argv[0] not in ('-h', '--help')):
+        argv = ['all', *argv]
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, 'scale', None) is not None:
+        if args.scale <= 0:
+            parser.error('--scale must be above 0')
+        use_render_scale(args.scale)
+    args.handler(args)
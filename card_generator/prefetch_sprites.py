@@ -0,0 +1,109 @@
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+from config import *
+from generate_pokemon import converted_pokedex_number, sprite_paths
+from io_utils import atomic_write
+from utils import read_cube
+
+
+def find_missing_sprites(cube):
+    missing = {}
+    for stats in cube:
+        paths = sprite_paths(stats)
+        if not any(path.is_file() for path in paths):
+            # Each mirror names its art differently, so keep every variant of the name
+            missing[paths[0]] = [converted_pokedex_number(stats, i) for i in (0, 1)]
+    return missing
+
+
+def get_session(concurrency=PREFETCH_CONCURRENCY, retries=PREFETCH_RETRIES, backoff=PREFETCH_BACKOFF):
+    # Busy mirrors are worth another try, but one that can't be connected to won't be there a moment later either, and
+    # retrying it for every sprite stalled offline builds for minutes
+    retry = Retry(total=retries, connect=0, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=len(SPRITE_MIRRORS), pool_maxsize=concurrency, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def download_sprite(session, sprite_path, names, mirrors=SPRITE_MIRRORS, timeout=PREFETCH_TIMEOUT, unreachable=None):
+    # Mirrors that couldn't be connected to are added to unreachable, and not tried again for the sprites sharing it
+    errors = []
+    unreachable = set() if unreachable is None else unreachable
+    for mirror_url, name_variant in mirrors:
+        url = f'{mirror_url}/{names[name_variant]}.png'
+        if mirror_url in unreachable:
+            errors.append(f'{url}: skipped, the mirror could not be reached')
+            continue
+        try:
+            response = session.get(url, timeout=timeout)
+            response.raise_for_status()
+            img = Image.open(BytesIO(response.content))
+            img.load()
+        except requests.ConnectionError as e:
+            unreachable.add(mirror_url)
+            errors.append(f'{url}: {e}')
+            continue
+        except (requests.RequestException, OSError) as e:
+            errors.append(f'{url}: {e}')
+            continue
+
+        # Write next to the final path and rename, so a failed save never leaves a broken sprite behind
+        with atomic_write(sprite_path) as tmp_path:
+            img.save(tmp_path, format='PNG')
+        return errors, True
+    return errors, False
+
+
+def get_mirrors(urls):
+    # The first mirror is asked for unpadded names, the rest for zero padded ones
+    return tuple((url, min(i, 1)) for i, url in enumerate(urls))
+
+
+def run(mirrors=SPRITE_MIRRORS, concurrency=PREFETCH_CONCURRENCY, timeout=PREFETCH_TIMEOUT, report_path=MISSING_SPRITES_REPORT):
+    missing = find_missing_sprites(read_cube())
+    print(f'Prefetching {len(missing)} missing sprites:')
+
+    unresolved = {}
+    unreachable = set()
+    with get_session(concurrency) as session, ThreadPoolExecutor(concurrency) as executor:
+        futures = {
+            executor.submit(download_sprite, session, sprite_path, names, mirrors, timeout, unreachable): sprite_path
+            for sprite_path, names in missing.items()
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            errors, found = future.result()
+            if not found:
+                unresolved[futures[future].stem] = errors
+
+    report_path = Path(report_path)
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(report_path, 'w') as f:
+        json.dump(dict(sorted(unresolved.items())), f, indent=2)
+    if unresolved:
+        print(f'{len(unresolved)} sprites could not be downloaded, see {report_path}')
+    if unreachable:
+        print(f"Couldn't connect to {', '.join(sorted(unreachable))}, skip prefetching with --no-prefetch when offline")
+    return unresolved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=PREFETCH_CONCURRENCY, help='number of downloads in flight at once')
+    parser.add_argument('--timeout', type=float, default=PREFETCH_TIMEOUT, help='seconds to wait on each request')
+    parser.add_argument('--mirror', action='append', default=None,
+                        help='base URL to download sprites from, tried in order; the first is asked for unpadded names, the rest for '
+                             'zero padded ones (default: the configured art mirrors)')
+    args = parser.parse_args()
+    mirrors = get_mirrors(args.mirror) if args.mirror else SPRITE_MIRRORS
+    run(mirrors=mirrors, concurrency=args.concurrency, timeout=args.timeout)
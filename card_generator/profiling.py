@@ -0,0 +1,99 @@
+import cProfile
+import csv
+import json
+import pstats
+import time
+from contextlib import contextmanager
+
+import config
+from config import *
+
+
+class StageTimer:
+    # Wall time spent in each named stage of one piece of work, like a card or a sheet
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+
+def counter_deltas(before, after):
+    return {name: value - before.get(name, 0) for name, value in after.items()}
+
+
+class ProfileReport:
+    # Collects the stage timings and cache counters of every piece of work a run did, which may have been done
+    # in other processes, and writes them out as {name}.json and {name}.csv
+    def __init__(self, name):
+        self.name = name
+        self.records = []
+        self.counters = {}
+
+    def add(self, item, stages, counters=None):
+        self.records.append({'item': item, 'total': sum(stages.values()), 'stages': stages})
+        for counter, value in (counters or {}).items():
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def stage_totals(self):
+        totals = {}
+        for record in self.records:
+            for stage, seconds in record['stages'].items():
+                totals[stage] = totals.get(stage, 0.0) + seconds
+        return totals
+
+    def slowest(self, top=PROFILE_TOP_N):
+        return sorted(self.records, key=lambda record: record['total'], reverse=True)[:top]
+
+    def save(self, report_dir=None):
+        # Looked up when saving rather than on import, since main.py may reload config for --draft or --scale after
+        # this module is loaded
+        report_dir = Path(report_dir or config.PROFILE_OUTPUT_DIR)
+        report_dir.mkdir(parents=True, exist_ok=True)
+        with open(report_dir / f'{self.name}.json', 'w') as f:
+            json.dump({'stages': self.stage_totals(), 'counters': self.counters, 'records': self.records}, f, indent=1)
+
+        stages = list(self.stage_totals())
+        with open(report_dir / f'{self.name}.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['item', 'total', *stages])
+            for record in self.records:
+                writer.writerow([record['item'], f"{record['total']:.6f}", *(f"{record['stages'].get(stage, 0.0):.6f}" for stage in stages)])
+        return report_dir
+
+    def print_summary(self, top=PROFILE_TOP_N):
+        totals = self.stage_totals()
+        total = sum(totals.values()) or 1.0
+        print(f'{self.name}: {len(self.records)} timed, {sum(totals.values()):.2f}s of work')
+        for stage, seconds in sorted(totals.items(), key=lambda item: item[1], reverse=True):
+            print(f'  {stage:<16} {seconds:8.2f}s {100 * seconds / total:5.1f}%')
+        if self.counters:
+            print('  ' + ', '.join(f'{counter} {value}' for counter, value in sorted(self.counters.items())))
+        print(f'Slowest {min(top, len(self.records))}:')
+        for record in self.slowest(top):
+            stages = ', '.join(f'{stage} {seconds * 1000:.0f}ms' for stage, seconds in record['stages'].items())
+            print(f"  {record['item']}: {record['total'] * 1000:.0f}ms ({stages})")
+
+
+@contextmanager
+def cprofiled(dump_path=None, top=PROFILE_TOP_N):
+    # Profiles the block with cProfile when given somewhere to dump the stats, only the calling process is seen
+    if dump_path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        Path(dump_path).parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(dump_path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(top)
+        print(f'cProfile stats written to {dump_path}')
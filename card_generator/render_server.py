@@ -0,0 +1,257 @@
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from multiprocessing import Pool
+from urllib.parse import urlparse
+
+from PIL import Image
+
+from asset_atlas import update_atlas
+from config import *
+from generate_decks import SHEET_CARD_SIZE, SheetCanvas
+from generate_pokemon import draw_card, card_fingerprint, card_front_path, _init_worker
+from utils import read_cube
+
+
+CARD_URL = re.compile(r'/cards/(\d+)\.png')
+SHEET_URL = re.compile(r'/sheets/(\d+)\.png')
+
+
+def encode_png(img):
+    buffer = BytesIO()
+    img.save(buffer, format='PNG', compress_level=SERVER_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+
+def render_preview(stats):
+    return encode_png(draw_card(stats))
+
+
+def compose_sheet_preview(card_pngs):
+    sheet = SheetCanvas()
+    for slot, card_png in enumerate(card_pngs):
+        card_img = Image.open(BytesIO(card_png)).convert('RGBA').resize(SHEET_CARD_SIZE)
+        sheet.add(card_img, slot)
+    return encode_png(sheet.to_image())
+
+
+def watched_files():
+    # The cube and every asset a card can be drawn from, with what's needed to tell they changed
+    paths = [ROOT_DIR / 'pokemon_dominion.xlsx', *(path for path in CARD_ASSETS_DIR.rglob('*') if path.is_file())]
+    files = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files[path] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+class CardRenderer:
+    # Keeps the cube and a pool of warm render workers around, and the PNG of every card previewed recently. Each
+    # cached card carries the fingerprint it was drawn from, so an edit only throws away the cards it touched
+    def __init__(self, workers=None, cache_size=SERVER_CACHE_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_size = cache_size
+        self.renders = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._cards = OrderedDict()
+        self._sheets = OrderedDict()
+        self._watched = watched_files()
+        self._pool = self._start_workers()
+        self.cube, self.fingerprints = [], []
+        self.reload()
+
+    def reload(self):
+        cube = read_cube()
+        fingerprints = [card_fingerprint(i, stats) for i, stats in enumerate(cube)]
+        with self._lock:
+            self.cube, self.fingerprints = cube, fingerprints
+            stale = [i for i, (fingerprint, _) in self._cards.items() if not self._is_current(i, fingerprint)]
+            for i in stale:
+                del self._cards[i]
+            for j in [j for j, (key, _) in self._sheets.items() if key != self._sheet_key(j)]:
+                del self._sheets[j]
+        return len(stale)
+
+    def _is_current(self, i, fingerprint):
+        return i < len(self.fingerprints) and self.fingerprints[i] == fingerprint
+
+    def _sheet_indices(self, j):
+        return range(j * CARDS_PER_SHEET, min((j + 1) * CARDS_PER_SHEET, len(self.cube)))
+
+    def _sheet_key(self, j):
+        return tuple(self.fingerprints[i] for i in self._sheet_indices(j))
+
+    def _start_workers(self):
+        # Workers map the asset atlas as they start, so it's repacked first if any asset changed
+        if USE_ASSET_ATLAS:
+            update_atlas()
+        return Pool(self.workers, initializer=_init_worker)
+
+    def restart_workers(self):
+        # Workers cache decoded assets by path, so changed assets need fresh workers. Cards already being drawn by
+        # the old ones are let finish, and aren't cached since their fingerprints no longer match
+        pool = self._start_workers()
+        with self._lock:
+            old_pool, self._pool = self._pool, pool
+        old_pool.close()
+        threading.Thread(target=old_pool.join, daemon=True).start()
+
+    def cards(self, indices):
+        pngs = {}
+        jobs = {}
+        with self._lock:
+            for i in indices:
+                entry = self._cards.get(i)
+                if entry and entry[0] == self.fingerprints[i]:
+                    self._cards.move_to_end(i)
+                    pngs[i] = entry[1]
+                    self.hits += 1
+                else:
+                    jobs[i] = (self.cube[i], self.fingerprints[i])
+            pool = self._pool
+
+        if jobs:
+            rendered = self._map(pool, render_preview, [stats for stats, _ in jobs.values()])
+            with self._lock:
+                self.renders += len(jobs)
+                for (i, (_, fingerprint)), png in zip(jobs.items(), rendered):
+                    pngs[i] = png
+                    if self._is_current(i, fingerprint):
+                        self._cards[i] = (fingerprint, png)
+                while len(self._cards) > self.cache_size:
+                    self._cards.popitem(last=False)
+        return [pngs[i] for i in indices]
+
+    def _map(self, pool, func, items):
+        # restart_workers() may close the pool between it being picked and used, in which case the new one takes over
+        while True:
+            try:
+                return pool.map(func, items)
+            except ValueError:
+                with self._lock:
+                    if self._pool is pool:
+                        raise
+                    pool = self._pool
+
+    def card(self, i):
+        if not 0 <= i < len(self.cube):
+            raise IndexError(i)
+        return self.cards([i])[0]
+
+    def sheet(self, j):
+        with self._lock:
+            indices = self._sheet_indices(j)
+            key = self._sheet_key(j)
+        if not indices:
+            raise IndexError(j)
+        card_pngs = self.cards(indices)
+        with self._lock:
+            entry = self._sheets.get(j)
+            if entry and entry[0] == key:
+                return entry[1]
+        png = compose_sheet_preview(card_pngs)
+        with self._lock:
+            self._sheets[j] = (key, png)
+            while len(self._sheets) > SERVER_SHEET_CACHE_SIZE:
+                self._sheets.popitem(last=False)
+        return png
+
+    def watch(self, stop, interval=SERVER_WATCH_INTERVAL):
+        while not stop.wait(interval):
+            files = watched_files()
+            changed = [path for path in files.keys() | self._watched.keys() if files.get(path) != self._watched.get(path)]
+            if not changed:
+                continue
+            self._watched = files
+            if any(path.suffix != '.xlsx' for path in changed):
+                self.restart_workers()
+            stale = self.reload()
+            print(f'{len(changed)} files changed, {stale} cached cards invalidated')
+
+    def listing(self):
+        return [
+            {'card': i, 'name': stats.pokedex_name, 'file': card_front_path(i, stats).name, 'url': f'/cards/{i}.png'}
+            for i, stats in enumerate(self.cube)
+        ]
+
+    def status(self):
+        with self._lock:
+            return {
+                'cards': len(self.cube), 'workers': self.workers, 'cached_cards': len(self._cards),
+                'cached_sheets': len(self._sheets), 'renders': self.renders, 'hits': self.hits,
+            }
+
+    def close(self):
+        self._pool.terminate()
+
+
+class PreviewHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        renderer = self.server.renderer
+        path = urlparse(self.path).path
+        start = time.perf_counter()
+        try:
+            if path == '/cards':
+                body, content_type = json.dumps(renderer.listing()).encode(), 'application/json'
+            elif path == '/status':
+                body, content_type = json.dumps(renderer.status()).encode(), 'application/json'
+            elif match := CARD_URL.fullmatch(path):
+                body, content_type = renderer.card(int(match[1])), 'image/png'
+            elif match := SHEET_URL.fullmatch(path):
+                body, content_type = renderer.sheet(int(match[1])), 'image/png'
+            else:
+                self.send_error(404, 'Try /cards, /cards/<n>.png, /sheets/<n>.png or /status')
+                return
+        except IndexError:
+            self.send_error(404, 'No such card or sheet')
+            return
+        except Exception as e:
+            # Answer rather than drop the connection, the server carries on with the next request
+            self.log_error('Failed to serve %s: %r', self.path, e)
+            self.send_error(500, 'Failed to render', repr(e))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Server-Timing', f'render;dur={(time.perf_counter() - start) * 1000:.1f}')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def run(host=SERVER_HOST, port=SERVER_PORT, workers=None):
+    renderer = CardRenderer(workers)
+    server = ThreadingHTTPServer((host, port), PreviewHandler)
+    server.renderer = renderer
+    stop = threading.Event()
+    watcher = threading.Thread(target=renderer.watch, args=(stop,), daemon=True)
+    watcher.start()
+    print(f'Previewing {len(renderer.cube)} cards on http://{host}:{port}/cards, press Ctrl+C to stop')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        renderer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=None, help='number of render processes (default: one per core)')
+    args = parser.parse_args()
+    run(args.host, args.port, args.workers)
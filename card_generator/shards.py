@@ -0,0 +1,222 @@
+import json
+import platform
+import shutil
+import time
+
+from tqdm import tqdm
+
+from build_manifest import file_hash, load_manifest, save_manifest
+from config import *
+from front_encoder import FrontEncoder
+from generate_pokemon import card_fingerprint, card_front_path, text_layer_summary, _render_rows, _remove_stale_outputs
+from io_utils import atomic_write
+from profiling import ProfileReport
+from utils import read_cube
+
+
+# Bump whenever the shard manifest changes, so shards rendered by older code have to be rendered again
+SHARD_VERSION = 1
+SHARD_MANIFEST_NAME = 'shard_manifest.json'
+
+
+#
+# Picking rows
+#
+
+def parse_shard(shard):
+    # 'K/N', the Kth of N shards counting from 1
+    try:
+        k, n = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError(f'Expected a shard like 2/4, got {shard!r}') from None
+    if not 1 <= k <= n:
+        raise ValueError(f'Shard {shard} is out of range, expected 1/{n} to {n}/{n}')
+    return k, n
+
+
+def shard_rows(card_count, k, n):
+    # Contiguous slices, so each shard's cards fill whole stretches of the same sheets
+    return list(range(card_count * (k - 1) // n, card_count * k // n))
+
+
+def parse_rows(rows, card_count):
+    # Comma separated cube rows counting from 0, each a single row or an inclusive range, open ended like 400- too
+    indices = set()
+    for part in rows.split(','):
+        first, dash, last = part.strip().partition('-')
+        try:
+            first = int(first)
+            last = (int(last) if last else card_count - 1) if dash else first
+        except ValueError:
+            raise ValueError(f'Expected rows like 0-139,280-349, got {rows!r}') from None
+        if not 0 <= first <= last < card_count:
+            raise ValueError(f'Rows {part.strip()} are out of range, the cube has rows 0 to {card_count - 1}')
+        indices.update(range(first, last + 1))
+    return sorted(indices)
+
+
+def shard_label(shard=None, rows=None):
+    return f'{shard[0]}-of-{shard[1]}' if shard else 'rows-' + rows.replace(',', '_').replace(' ', '')
+
+
+#
+# Rendering a shard
+#
+
+def cube_digest():
+    return file_hash(ROOT_DIR / 'pokemon_dominion.xlsx')
+
+
+def load_shard_manifest(shard_dir):
+    with open(Path(shard_dir) / SHARD_MANIFEST_NAME) as f:
+        return json.load(f)
+
+
+def save_shard_manifest(shard_dir, shard_manifest):
+    # Written through a temporary file like the build manifest, so an interrupted shard never leaves half of one
+    manifest_path = Path(shard_dir) / SHARD_MANIFEST_NAME
+    with atomic_write(manifest_path) as tmp_path, open(tmp_path, 'w') as f:
+        json.dump(shard_manifest, f, indent=1, sort_keys=True)
+
+
+def render_shard(indices, shard_dir, label, workers=None, profile=False, encoder=FrontEncoder()):
+    # Renders the given cube rows into shard_dir/card_fronts and records each card in shard_dir's manifest: the
+    # fingerprint of what it was drawn from, the hash of the file and how long it took. Rerunning the same shard
+    # only renders the cards it's missing, or whose inputs changed since. Without a shard_dir it goes under the
+    # shards directory of the scale being rendered at
+    print(f'Rendering shard {label}:')
+    shard_dir = Path(shard_dir) if shard_dir else SHARDS_OUTPUT_DIR / label
+    fronts_dir = shard_dir / 'card_fronts'
+    fronts_dir.mkdir(parents=True, exist_ok=True)
+
+    cube = read_cube()
+    digest = cube_digest()
+    try:
+        previous = load_shard_manifest(shard_dir)
+        cards = previous['cards'] if (previous['version'], previous['cube']) == (SHARD_VERSION, digest) else {}
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        cards = {}
+
+    fingerprints = {}
+    kept = {}
+    rows = []
+    for i in indices:
+        name = card_front_path(i, cube[i]).name
+        fingerprints[i] = card_fingerprint(i, cube[i])
+        card = cards.get(name)
+        if card and card['fingerprint'] == fingerprints[i] and file_hash(fronts_dir / name) == card['sha256']:
+            kept[name] = card
+        else:
+            rows.append((i, cube[i]))
+    cards = kept
+    print(f'{len(rows)} of {len(indices)} cards to render')
+
+    shard_manifest = {
+        'version': SHARD_VERSION, 'shard': label, 'cube': digest, 'card_count': len(cube), 'scale': RENDER_SCALE,
+        'rows': list(indices), 'host': platform.node(), 'cards': cards,
+    }
+    report = ProfileReport('card_fronts')
+    start = time.perf_counter()
+    try:
+        rendered = _render_rows(rows, workers, output_dir=fronts_dir, encoder=encoder)
+        for i, output_path, _, (stages, counters) in tqdm(rendered, total=len(rows)):
+            cards[output_path.name] = {
+                'index': i, 'fingerprint': fingerprints[i], 'sha256': file_hash(output_path),
+                'seconds': round(sum(stages.values()), 4), 'stages': {stage: round(seconds, 4) for stage, seconds in stages.items()},
+            }
+            report.add(output_path.name, stages, counters)
+    finally:
+        # Cards finished before an interruption are recorded, so they aren't rendered again
+        shard_manifest['seconds'] = round(time.perf_counter() - start, 3)
+        save_shard_manifest(shard_dir, shard_manifest)
+
+    if profile:
+        report.save(shard_dir / 'profile')
+        report.print_summary()
+        print(text_layer_summary(report.counters))
+    return shard_manifest
+
+
+#
+# Merging
+#
+
+def find_shard_dirs(shards_dir=SHARDS_OUTPUT_DIR):
+    return sorted(path.parent for path in Path(shards_dir).glob(f'*/{SHARD_MANIFEST_NAME}'))
+
+
+def check_shards(shard_dirs, cube, partial=False):
+    # Every problem that makes the shards unfit to merge into this checkout's build, and which shard each row's card
+    # comes from
+    problems = []
+    digest = cube_digest()
+    owners = {}
+    for shard_dir in shard_dirs:
+        try:
+            shard_manifest = load_shard_manifest(shard_dir)
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            problems.append(f'{shard_dir}: no readable {SHARD_MANIFEST_NAME} ({e})')
+            continue
+        label = shard_manifest.get('shard', shard_dir.name)
+        if shard_manifest.get('version') != SHARD_VERSION:
+            problems.append(f'{label}: rendered by a different version of the shard code')
+            continue
+        if shard_manifest['cube'] != digest or shard_manifest['card_count'] != len(cube):
+            problems.append(f'{label}: rendered from a different cube')
+            continue
+        if shard_manifest['scale'] != RENDER_SCALE:
+            problems.append(f"{label}: rendered at scale {shard_manifest['scale']:g}, not {RENDER_SCALE:g}")
+            continue
+
+        for name, card in shard_manifest['cards'].items():
+            i = card['index']
+            if not 0 <= i < len(cube) or card_front_path(i, cube[i]).name != name:
+                problems.append(f'{label}: {name} is not row {i} of the cube')
+                continue
+            if i in owners:
+                problems.append(f'{label}: {name} was also rendered by {owners[i][0]}')
+                continue
+            if card['fingerprint'] != card_fingerprint(i, cube[i]):
+                problems.append(f'{label}: {name} was drawn from different assets or code than this checkout has')
+                continue
+            if file_hash(card_front_path(i, cube[i], Path(shard_dir) / 'card_fronts')) != card['sha256']:
+                problems.append(f'{label}: {name} is missing or differs from the file the shard rendered')
+                continue
+            owners[i] = (label, shard_dir, card)
+
+    missing = [i for i in range(len(cube)) if i not in owners]
+    if missing and not partial:
+        problems.append(f'{len(missing)} rows were not rendered by any shard, starting with {missing[:10]}')
+    return problems, owners
+
+
+def merge_shards(shard_dirs=None, partial=False):
+    # Validates the shards against this checkout and copies their cards into the card fronts directory, recording
+    # them in the build manifest as if rendered here, so the deck sheets and incremental builds pick them up.
+    # Without partial the shards must cover the whole cube, and fronts of cards no longer in it are removed
+    shard_dirs = [Path(shard_dir) for shard_dir in shard_dirs] if shard_dirs else find_shard_dirs()
+    if not shard_dirs:
+        raise ValueError(f'No shards to merge under {SHARDS_OUTPUT_DIR}')
+    cube = read_cube()
+    print(f'Merging {len(shard_dirs)} shards:')
+    problems, owners = check_shards(shard_dirs, cube, partial)
+    if problems:
+        raise ValueError(f'{len(problems)} problems with the shards:\n  ' + '\n  '.join(problems))
+
+    CARD_FRONTS_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(CARD_FRONTS_MANIFEST)
+    seconds = {}
+    for i, (label, shard_dir, card) in tqdm(sorted(owners.items()), total=len(owners)):
+        output_path = card_front_path(i, cube[i])
+        # Copied in whole or not at all, so an interrupted merge can't leave a broken front under its old fingerprint
+        with atomic_write(output_path) as tmp_path:
+            shutil.copyfile(card_front_path(i, cube[i], shard_dir / 'card_fronts'), tmp_path)
+        manifest[output_path.name] = card['fingerprint']
+        seconds[label] = seconds.get(label, 0.0) + card['seconds']
+    if not partial:
+        _remove_stale_outputs(manifest, {card_front_path(i, stats).name for i, stats in enumerate(cube)})
+    save_manifest(CARD_FRONTS_MANIFEST, manifest)
+
+    for label, total in sorted(seconds.items()):
+        print(f'{label}: {sum(owner[0] == label for owner in owners.values())} cards, {total:.1f}s of rendering')
+    return len(owners)
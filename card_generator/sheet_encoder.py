@@ -0,0 +1,19 @@
+from collections import namedtuple
+
+from config import *
+
+
+SHEET_EXTENSIONS = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp'}
+
+SheetEncoder = namedtuple('SheetEncoder', ['format', 'compress_level', 'quality'],
+                          defaults=(SHEET_FORMAT, SHEET_COMPRESS_LEVEL, SHEET_QUALITY))
+
+
+def add_encoder_arguments(parser):
+    parser.add_argument('--sheet-format', choices=SHEET_EXTENSIONS, default=SHEET_FORMAT, help='image format of the deck sheets')
+    parser.add_argument('--compress-level', type=int, default=SHEET_COMPRESS_LEVEL, help='zlib level for png sheets, 0-9')
+    parser.add_argument('--quality', type=int, default=SHEET_QUALITY, help='quality for jpeg and webp sheets, 1-100')
+
+
+def get_encoder(args):
+    return SheetEncoder(args.sheet_format, args.compress_level, args.quality)
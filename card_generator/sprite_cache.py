@@ -0,0 +1,74 @@
+
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+from build_manifest import file_hash
+from config import *
+from io_utils import atomic_write
+from utils import get_img
+
+
+# Sprites served from the cache and preprocessed so far in this process
+sprite_counters = {'hits': 0, 'misses': 0}
+
+
+def trim_box(img):
+    # NumPy is only needed for sprites that aren't cached yet, so it isn't loaded for runs that don't have any
+    import numpy as np
+
+    # Box around every pixel whose alpha is more than 100 off the top left corner's, the same box the old
+    # ImageChops difference and getbbox trim found (getbbox only looks at the alpha band of an RGBA image)
+    alpha = np.asarray(img.getchannel('A'), dtype=np.int16)
+    mask = np.abs(alpha - alpha[0, 0]) > 100
+    rows = np.flatnonzero(mask.any(axis=1))
+    if not rows.size:
+        return None
+    columns = np.flatnonzero(mask.any(axis=0))
+    return int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+
+
+def preprocess_sprite(sprite_path, size):
+    img = get_img(sprite_path, size)
+    # Art with nothing standing out from its corner is used whole rather than dropped
+    box = trim_box(img) or (0, 0, *img.size)
+    return img.crop(box), box
+
+
+def sprite_cache_path(sprite_path, size):
+    digest = file_hash(sprite_path)
+    return SPRITE_CACHE_DIR / f'{Path(sprite_path).stem}-{size[0]}x{size[1]}-{digest[:16]}.png'
+
+
+def load_cached_sprite(cache_path, size):
+    # The cached sprite if it decodes whole and matches the crop box saved in its metadata, which has to lie within
+    # size. Anything else, like a file cut short or one saved without a box, is None and preprocessed again
+    try:
+        img = Image.open(cache_path)
+        img.load()
+        left, top, right, bottom = map(int, img.text['box'].split(','))
+    except (OSError, KeyError, ValueError):
+        return None
+    if img.size != (right - left, bottom - top) or min(left, top) < 0 or right > size[0] or bottom > size[1]:
+        return None
+    return img
+
+
+def get_sprite(sprite_path, size):
+    # Trimmed sprites are kept on disk under the hash of their source, so replaced art is picked up while unchanged
+    # art is never decoded at full size or trimmed again
+    cache_path = sprite_cache_path(sprite_path, size)
+    img = load_cached_sprite(cache_path, size)
+    if img is not None:
+        sprite_counters['hits'] += 1
+        return img
+
+    sprite_counters['misses'] += 1
+
+    img, box = preprocess_sprite(sprite_path, size)
+    info = PngInfo()
+    info.add_text('box', ','.join(map(str, box)))
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Workers may preprocess the same sprite at once, each writes its own file and the last rename wins
+    with atomic_write(cache_path) as tmp_path:
+        img.save(tmp_path, format='PNG', pnginfo=info, compress_level=1)
+    return img
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The generator's modules import each other by name, as they do when run from card_generator
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
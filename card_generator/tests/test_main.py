@@ -0,0 +1,19 @@
+import os
+import subprocess
+import sys
+
+from PIL import Image
+
+from config import COMPONENT_DIR
+
+
+def test_draft_render_writes_draft_size_fronts(tmp_path):
+    # A process of its own, so the scale is applied the way the command line does it, before any stage is imported
+    env = {key: value for key, value in os.environ.items() if key != 'CARD_RENDER_SCALE'}
+    subprocess.run([sys.executable, 'main.py', 'render', '--draft', '--rows', '0-3', '--shard-dir', str(tmp_path), '--workers', '1'],
+                   cwd=COMPONENT_DIR, env=env, check=True)
+    fronts = sorted((tmp_path / 'card_fronts').glob('*.png'))
+    assert len(fronts) == 4
+    for front in fronts:
+        with Image.open(front) as img:
+            assert img.size == (256, 368)
@@ -0,0 +1,84 @@
+import socket
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+from PIL import Image
+
+from prefetch_sprites import download_sprite, get_session
+
+
+# Seconds, well under the backoff of retrying even one connection
+FAIL_FAST_SECONDS = 1.0
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    # A stand-in for the art mirrors, with only the zero padded name the second one is asked for
+    served = tmp_path / 'served'
+    served.mkdir()
+    Image.new('RGBA', (8, 8), (255, 0, 0, 255)).save(served / '025.png')
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=served))
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def closed_port():
+    # Nothing listens on it once the socket is closed, so connecting is refused
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def counted_session(calls):
+    session = get_session()
+    get = session.get
+    session.get = lambda url, **kwargs: calls.append(url) or get(url, **kwargs)
+    return session
+
+
+def test_falls_back_to_the_next_mirror(tmp_path, mirror):
+    sprite_path = tmp_path / 'pikachu.png'
+    errors, found = download_sprite(get_session(), sprite_path, ['25', '025'], ((mirror, 0), (mirror, 1)), timeout=5)
+    assert found
+    assert len(errors) == 1 and '404' in errors[0]
+    assert Image.open(sprite_path).size == (8, 8)
+
+
+def test_gives_up_on_an_unreachable_mirror(tmp_path, mirror, closed_port):
+    dead = f'http://127.0.0.1:{closed_port}'
+    calls = []
+    session = counted_session(calls)
+    unreachable = set()
+    start = time.perf_counter()
+    for n in range(3):
+        errors, found = download_sprite(session, tmp_path / f'{n}.png', ['25', '025'], ((dead, 0), (mirror, 1)), timeout=5,
+                                        unreachable=unreachable)
+        assert found
+    # Refused once without retrying, then skipped for the sprites after it
+    assert unreachable == {dead}
+    assert [url for url in calls if url.startswith(dead)] == [f'{dead}/25.png']
+    assert time.perf_counter() - start < FAIL_FAST_SECONDS
+
+
+def test_fails_fast_when_no_mirror_is_reachable(tmp_path, closed_port):
+    dead = f'http://127.0.0.1:{closed_port}'
+    unreachable = set()
+    start = time.perf_counter()
+    for n in range(5):
+        errors, found = download_sprite(get_session(), tmp_path / f'{n}.png', ['25', '025'], ((dead, 0), (dead, 1)), timeout=5,
+                                        unreachable=unreachable)
+        assert not found and len(errors) == 2
+    assert not any(tmp_path.iterdir())
+    assert time.perf_counter() - start < FAIL_FAST_SECONDS
+
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from config import *
+import generate_decks
+from generate_decks import SHEET_CARD_SIZE, SheetAssembler, SheetCanvas, get_card_pos
+from utils import get_asset, pos
+
+
+def paste_sheet(card_imgs):
+    # How sheets were put together before the canvas, one masked paste per card
+    sheet = Image.new('RGBA', pos(10, 7))
+    for slot, card_img in enumerate(card_imgs):
+        sheet.paste(card_img, get_card_pos(slot), card_img)
+    return sheet
+
+
+def opaque_card(seed):
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, (SHEET_CARD_SIZE[1], SHEET_CARD_SIZE[0], 4), dtype=np.uint8)
+    pixels[..., 3] = 255
+    return Image.fromarray(pixels)
+
+
+def rounded_card(seed):
+    # Opaque in the middle, antialiased rounded corners fading out to fully transparent
+    card_img = opaque_card(seed)
+    alpha = Image.new('L', SHEET_CARD_SIZE, 0)
+    ImageDraw.Draw(alpha).rounded_rectangle((0, 0, SHEET_CARD_SIZE[0] - 1, SHEET_CARD_SIZE[1] - 1), radius=24, fill=255)
+    alpha = alpha.resize((SHEET_CARD_SIZE[0] // 2, SHEET_CARD_SIZE[1] // 2)).resize(SHEET_CARD_SIZE)
+    card_img.putalpha(alpha)
+    return card_img
+
+
+def translucent_card(seed):
+    # Every alpha value, as a stress test of the blend's rounding
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (SHEET_CARD_SIZE[1], SHEET_CARD_SIZE[0], 4), dtype=np.uint8))
+
+
+@pytest.mark.parametrize('make_card', [opaque_card, rounded_card, translucent_card])
+def test_front_sheet_matches_paste(make_card):
+    card_imgs = [make_card(slot) for slot in range(CARDS_PER_SHEET - 3)]
+    canvas = SheetCanvas()
+    for slot, card_img in enumerate(card_imgs):
+        canvas.add(card_img, slot)
+    assert canvas.to_image().tobytes() == paste_sheet(card_imgs).tobytes()
+
+
+def test_cleared_canvas_matches_paste():
+    canvas = SheetCanvas()
+    canvas.add(translucent_card(0), 0)
+    canvas.clear()
+    card_imgs = [rounded_card(slot) for slot in range(4)]
+    for slot, card_img in enumerate(card_imgs):
+        canvas.add(card_img, slot)
+    assert canvas.to_image().tobytes() == paste_sheet(card_imgs).tobytes()
+
+
+@pytest.mark.parametrize('card_back_img', [
+    get_asset(CARD_ASSETS_DIR / 'card_backs' / 'standard.png', SHEET_CARD_SIZE),
+    # The standard back is opaque, so the blend of one card copied into many slots needs a translucent one too
+    rounded_card(0),
+], ids=['standard', 'rounded'])
+def test_back_sheet_matches_paste(card_back_img):
+    canvas = SheetCanvas()
+    canvas.add_all(card_back_img, range(CARDS_PER_SHEET))
+    assert canvas.to_image().tobytes() == paste_sheet([card_back_img] * CARDS_PER_SHEET).tobytes()
+
+
+@pytest.mark.parametrize('flush', [True, False])
+def test_assembler_only_writes_unfinished_sheets_when_flushed(tmp_path, monkeypatch, flush):
+    monkeypatch.setattr(generate_decks, 'DECKS_OUTPUT_DIR', tmp_path)
+    assembler = SheetAssembler(CARDS_PER_SHEET + 2, queue_size=4)
+    for i in range(CARDS_PER_SHEET + 1):
+        assembler.put(i, None, opaque_card(i))
+    assembler.close(flush=flush)
+    written = {path.name for path in tmp_path.glob('*_deck.png')}
+    # The first sheet is whole either way, the second is missing a card
+    assert written == {'0a_deck.png', '0b_deck.png'} | ({'1a_deck.png', '1b_deck.png'} if flush else set())
@@ -0,0 +1,54 @@
+import pytest
+from PIL import Image, ImageDraw
+from PIL.PngImagePlugin import PngInfo
+
+import sprite_cache
+from sprite_cache import get_sprite, sprite_cache_path
+
+
+SIZE = (64, 64)
+
+
+@pytest.fixture
+def sprite_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(sprite_cache, 'SPRITE_CACHE_DIR', tmp_path / 'sprites')
+    # A blob on a transparent background, trimmed to the box around it
+    img = Image.new('RGBA', (128, 128))
+    ImageDraw.Draw(img).ellipse((30, 20, 90, 110), fill=(200, 40, 40, 255))
+    path = tmp_path / 'art.png'
+    img.save(path)
+    return path
+
+
+def get_counted(sprite_path):
+    before = dict(sprite_cache.sprite_counters)
+    img = get_sprite(sprite_path, SIZE)
+    return img, {key: sprite_cache.sprite_counters[key] - before[key] for key in before}
+
+
+def test_cached_sprite_is_reused(sprite_path):
+    drawn, counts = get_counted(sprite_path)
+    assert counts == {'hits': 0, 'misses': 1}
+    cached, counts = get_counted(sprite_path)
+    assert counts == {'hits': 1, 'misses': 0}
+    assert cached.tobytes() == drawn.tobytes()
+
+
+@pytest.mark.parametrize('damage', ['truncated', 'no box', 'wrong box'])
+def test_damaged_cached_sprite_is_preprocessed_again(sprite_path, damage):
+    drawn, _ = get_counted(sprite_path)
+    cache_path = sprite_cache_path(sprite_path, SIZE)
+    if damage == 'truncated':
+        cache_path.write_bytes(cache_path.read_bytes()[:-40])
+    elif damage == 'no box':
+        drawn.save(cache_path)
+    else:
+        # A box that doesn't match the sprite saved with it
+        info = PngInfo()
+        info.add_text('box', '0,0,1,1')
+        drawn.save(cache_path, pnginfo=info)
+
+    redrawn, counts = get_counted(sprite_path)
+    assert counts == {'hits': 0, 'misses': 1}
+    assert redrawn.tobytes() == drawn.tobytes()
+
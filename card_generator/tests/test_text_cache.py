@@ -0,0 +1,57 @@
+import pytest
+from PIL import Image, ImageDraw
+
+import generate_pokemon
+import text_cache
+import utils
+from utils import read_cube, xy
+
+
+def draw_text_directly(d, xy, text, font, fill=None, anchor=None):
+    d.text(xy, text, fill=fill, font=font, anchor=anchor)
+
+
+def text_layer(cube):
+    img = Image.new('RGBA', xy(16, 23), (240, 230, 200, 255))
+    for stats in cube:
+        generate_pokemon.add_text(img, stats)
+    return img.tobytes()
+
+
+@pytest.fixture
+def cube():
+    # Every format, long ability texts and the same stat numbers over and over
+    return read_cube()[:60]
+
+
+@pytest.fixture(autouse=True)
+def empty_text_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(text_cache, 'TEXT_LAYER_CACHE_DIR', tmp_path / 'text_layers')
+    text_cache._layers.clear()
+    yield
+    text_cache._layers.clear()
+
+
+def test_cached_text_matches_drawing_directly(cube, monkeypatch):
+    with monkeypatch.context() as direct:
+        direct.setattr(generate_pokemon, 'wrapped_text', utils.wrapped_text)
+        direct.setattr(generate_pokemon, 'draw_text', draw_text_directly)
+        expected = text_layer(cube)
+
+    counters = dict(text_cache.text_layer_counters)
+    assert text_layer(cube) == expected
+    assert text_cache.text_layer_counters['misses'] > counters['misses']
+    assert text_cache.text_layer_counters['hits'] > counters['hits']
+
+    # Read back from disk, as the next run would
+    text_cache._layers.clear()
+    counters = dict(text_cache.text_layer_counters)
+    assert text_layer(cube) == expected
+    assert text_cache.text_layer_counters['misses'] == counters['misses']
+
+
+def test_blank_text_draws_nothing():
+    img = Image.new('RGBA', xy(16, 23))
+    layout = text_cache.draw_text(ImageDraw.Draw(img), xy(6.5, 2), ' ', utils.text_font(20), fill=(0, 0, 0), anchor='mm')
+    assert layout.text == ' '
+    assert img.getbbox() is None
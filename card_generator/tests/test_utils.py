@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+from io_utils import WorkerQueue, atomic_write
+
+
+def test_atomic_write_replaces_the_file(tmp_path):
+    path = tmp_path / 'manifest.json'
+    path.write_text('old')
+    with atomic_write(path) as tmp:
+        tmp.write_text('new')
+        assert path.read_text() == 'old'
+    assert path.read_text() == 'new'
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_atomic_write_keeps_the_old_file_on_error(tmp_path):
+    path = tmp_path / 'manifest.json'
+    path.write_text('old')
+    with pytest.raises(RuntimeError):
+        with atomic_write(path) as tmp:
+            tmp.write_text('half')
+            raise RuntimeError
+    assert path.read_text() == 'old'
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_worker_queue_handles_every_job():
+    handled = []
+    lock = threading.Lock()
+
+    def handle(i, square):
+        with lock:
+            handled.append((i, square))
+
+    workers = WorkerQueue(handle, threads=3, queue_size=2)
+    for i in range(50):
+        workers.put(i, i * i)
+    workers.close()
+    assert sorted(handled) == [(i, i * i) for i in range(50)]
+
+
+def test_worker_queue_raises_the_first_error_without_blocking():
+    def handle(i):
+        if i == 3:
+            raise ValueError(i)
+
+    workers = WorkerQueue(handle, queue_size=1)
+    with pytest.raises(ValueError):
+        # Once the error is in, put() raises it rather than waiting on a full queue
+        for i in range(1000):
+            workers.put(i)
+    with pytest.raises(ValueError, match='3'):
+        workers.close()
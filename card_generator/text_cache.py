@@ -0,0 +1,129 @@
+import hashlib
+import pickle
+import zlib
+from collections import OrderedDict, namedtuple
+
+from PIL import Image, ImageDraw, ImageFont
+from PIL import __version__ as PIL_VERSION
+
+from build_manifest import file_hash
+from config import *
+from io_utils import atomic_write
+import utils
+from utils import TextLayout, fonts
+
+
+# Bump whenever what's stored for a layer changes, so layers saved the old way are drawn again
+TEXT_LAYER_VERSION = 2
+
+# Text layers found in memory, read from disk and drawn from scratch so far in this process
+text_layer_counters = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+
+# A block of text as drawn: the layout it was fitted to, and a matte of its glyphs with where it goes on the card.
+# Text that draws nothing, like a blank line, has no matte
+TextLayer = namedtuple('TextLayer', ['layout', 'origin', 'matte'])
+
+_layers = OrderedDict()
+# Scratch matte text is recorded on, blank between recordings
+_matte = None
+
+
+def _record(draw):
+    # Runs draw(d, fill) against a blank matte the size of a card, drawing in white, and keeps the part it covered.
+    # ImageDraw.text blends the fill through the glyphs of each line exactly the way ImageDraw.bitmap blends it
+    # through a matte, so drawing the layer back with bitmap gives the same pixels as drawing the text directly
+    global _matte
+    if _matte is None or _matte.size != utils.xy(16, 23):
+        _matte = Image.new('L', utils.xy(16, 23))
+    layout = draw(ImageDraw.Draw(_matte), 255)
+    box = _matte.getbbox()
+    if box is None:
+        return TextLayer(layout, (0, 0), None)
+    layer = TextLayer(layout, box[:2], _matte.crop(box))
+    # Only the covered part is wiped, which is far cheaper than a fresh matte for every block of text
+    _matte.paste(0, box)
+    return layer
+
+
+def _draw_layer(d, layer, fill):
+    if layer.matte is not None:
+        d.bitmap(layer.origin, layer.matte, fill=fill)
+    return layer.layout
+
+
+def text_layer_path(key, font_path):
+    # Rasterizing depends on the font file and the FreeType build as much as on the text, so they're hashed in too
+    identity = (TEXT_LAYER_VERSION, PIL_VERSION, ImageFont.core.freetype2_version, file_hash(font_path), key)
+    return TEXT_LAYER_CACHE_DIR / f'{hashlib.sha256(repr(identity).encode("utf-8")).hexdigest()}.pickle'
+
+
+def _load_layer(cache_path):
+    try:
+        with open(cache_path, 'rb') as f:
+            stored = pickle.load(f)
+        matte = stored['matte'] and Image.frombytes('L', stored['matte'][0], zlib.decompress(stored['matte'][1]))
+    except (FileNotFoundError, pickle.UnpicklingError, EOFError, KeyError, zlib.error):
+        return None
+    return TextLayer(TextLayout(fonts.get(stored['font_path'], stored['font_size']), stored['text']), stored['origin'], matte)
+
+
+def _save_layer(cache_path, layer):
+    stored = {
+        'font_path': layer.layout.font.path, 'font_size': layer.layout.font.full_size, 'text': layer.layout.text,
+        'origin': layer.origin,
+        # Mattes are mostly empty space around the glyphs, which even the fastest compression squeezes several times
+        'matte': layer.matte and (layer.matte.size, zlib.compress(layer.matte.tobytes(), 1)),
+    }
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Workers may draw the same text at once, each writes its own file and the last rename wins
+    with atomic_write(cache_path) as tmp_path, open(tmp_path, 'wb') as f:
+        pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def get_text_layer(key, font, draw):
+    # The layer for key from memory, then from disk, and only then drawn from scratch with draw(d, fill)
+    layer = _layers.get(key)
+    if layer is not None:
+        _layers.move_to_end(key)
+        text_layer_counters['hits'] += 1
+        return layer
+
+    cache_path = text_layer_path(key, font.path)
+    layer = _load_layer(cache_path)
+    if layer is not None:
+        text_layer_counters['disk_hits'] += 1
+    else:
+        text_layer_counters['misses'] += 1
+        layer = _record(draw)
+        _save_layer(cache_path, layer)
+
+    _layers[key] = layer
+    if len(_layers) > TEXT_LAYER_CACHE_SIZE:
+        _layers.popitem(last=False)
+    return layer
+
+
+def wrapped_text(d, text, font, boundaries, alignment, *args, fill=None, **kwargs):
+    # utils.wrapped_text, fitting and rasterizing each block of text once. The fill is applied as the layer is
+    # drawn, so it's the only argument that doesn't need a layer of its own
+    key = ('wrapped', text, font.path, font.full_size, font.size, tuple(boundaries), alignment, utils.LINE_SPACING, args,
+           tuple(sorted(kwargs.items())))
+    layer = get_text_layer(key, font, lambda d, ink: utils.wrapped_text(d, text, font, boundaries, alignment, *args, fill=ink, **kwargs))
+    return _draw_layer(d, layer, fill)
+
+
+def draw_text(d, xy, text, font, fill=None, anchor=None):
+    # ImageDraw.text for a single line, rasterized once
+    key = ('text', text, font.path, font.size, tuple(xy), anchor)
+
+    def draw(recording, ink):
+        recording.text(xy, text, fill=ink, font=font, anchor=anchor)
+        return TextLayout(font, text)
+
+    return _draw_layer(d, get_text_layer(key, font, draw), fill)
+
+
+def text_layer_stats(counters=text_layer_counters):
+    looked_up = sum(counters.values())
+    reused = counters['hits'] + counters['disk_hits']
+    return {**counters, 'hit_ratio': reused / looked_up if looked_up else 0.0}
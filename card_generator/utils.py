@@ -1,54 +1,260 @@
-import pandas as pd
+import os
+from collections import OrderedDict, namedtuple
+from io import BytesIO
+
 from PIL import Image, ImageFont
 
 from config import *
+from cube import read_cube
+
+
+# Pixels per cm of card, 64 at full scale
+PX_PER_CM = 64 * RENDER_SCALE
+# Pixels between lines of wrapped text, PIL's default of 4 at full scale
+LINE_SPACING = max(1, round(4 * RENDER_SCALE))
 
 
-def xy(width_cm, height_cm):
-    return int(64 * width_cm), int(64 * height_cm)
+def xy(width_cm, height_cm, scale=RENDER_SCALE):
+    return int(64 * scale * width_cm), int(64 * scale * height_cm)
 
 
 def pos(x, y):
-    return int(512 * x), int(736 * y)
+    return int(512 * RENDER_SCALE * x), int(736 * RENDER_SCALE * y)
 
 
 def _adjusted_font_size(font_size):
     return int(2.25 * font_size)
 
 
+class FontRegistry:
+    def __init__(self):
+        self.loads = 0
+        self.hits = 0
+        self._font_files = {}
+        self._fonts = {}
+
+    def get(self, path, size, scale=RENDER_SCALE):
+        # size is in pixels at full scale, and the font is loaded at that times scale
+        key = (path, size, scale)
+        font = self._fonts.get(key)
+        if font is not None:
+            self.hits += 1
+            return font
+
+        self.loads += 1
+        if path not in self._font_files:
+            with open(path, 'rb') as f:
+                self._font_files[path] = f.read()
+        font = ImageFont.truetype(BytesIO(self._font_files[path]), size=max(1, round(size * scale)))
+        # Keep the file path and full scale size so callers can look up other sizes of the same font
+        font.path = path
+        font.full_size = size
+        self._fonts[key] = font
+        return font
+
+    def stats(self):
+        return {'fonts': len(self._fonts), 'font_files': len(self._font_files), 'loads': self.loads, 'loads_avoided': self.hits}
+
+
+fonts = FontRegistry()
+
+
 def text_font(size):
-    return ImageFont.truetype(BARLOW_PATH, size=_adjusted_font_size(size))
+    return fonts.get(BARLOW_PATH, _adjusted_font_size(size))
 
 
 def title_font(size):
-    return ImageFont.truetype(ORIENTAL_PATH, size=_adjusted_font_size(size))
+    return fonts.get(ORIENTAL_PATH, _adjusted_font_size(size))
 
 
-def read_cube(cube_name='pokemon_dominion', sheet_name='pokemon'):
-    df = pd.read_excel(ROOT_DIR / f'{cube_name}.xlsx', sheet_name)
-    return df
+def warm_caches(preload_assets=PRELOAD_ASSETS):
+    for size in TEXT_FONT_SIZES:
+        text_font(size)
+    for size in TITLE_FONT_SIZES:
+        title_font(size)
+    if preload_assets:
+        asset_cache.preload()
 
 
 def get_img(file_path, size):
     return Image.open(file_path).convert('RGBA').resize(size)
 
 
-def wrapped_text(d, text, font, boundaries, alignment, *args, **kwargs):
-    words = text.split(' ')
-    multiline_text_list = []
-    _offset = ()
+#
+# Asset Cache
+#
+
+# Every (size) each asset directory is drawn at, used to preload the cache
+ASSET_SIZES = {
+    'card_bases': (xy(16, 23),),
+    'biomes': (xy(16, 11),),
+    'frame_overlays': (xy(16, 23),),
+    'stats_bases': (xy(2, 2), xy(1.75, 1.75)),
+    'types': (xy(1, 1),),
+    'card_backs': (xy(8, 11.5),),
+}
+
+
+def asset_files(asset_dir=CARD_ASSETS_DIR):
+    # Every asset file with the sizes it's drawn at
+    for sub_dir, sizes in ASSET_SIZES.items():
+        for file_path in sorted((asset_dir / sub_dir).glob('*')):
+            if file_path.suffix.lower() == '.png':
+                yield file_path, sizes
+
+
+class AssetCache:
+    def __init__(self, maxsize=ASSET_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.atlas_hits = 0
+        # An AssetAtlas to take decoded assets from before decoding them here, see asset_atlas.py
+        self.atlas = None
+        self._images = OrderedDict()
+
+    def get(self, file_path, size):
+        key = (os.path.normcase(file_path), tuple(size))
+        img = self._images.get(key)
+        if img is not None:
+            self._images.move_to_end(key)
+            self.hits += 1
+            return img
+
+        self.misses += 1
+        img = self.atlas.get(file_path, size) if self.atlas is not None else None
+        if img is not None:
+            self.atlas_hits += 1
+        else:
+            img = get_img(file_path, size)
+        self._images[key] = img
+        if len(self._images) > self.maxsize:
+            self._images.popitem(last=False)
+        return img
+
+    def preload(self, asset_dir=CARD_ASSETS_DIR):
+        for file_path, sizes in asset_files(asset_dir):
+            for size in sizes:
+                self.get(file_path, size)
+
+    def clear(self):
+        self._images.clear()
+        self.hits = 0
+        self.misses = 0
+        self.atlas_hits = 0
+
+    def stats(self):
+        return {
+            'size': len(self._images), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+            'atlas_hits': self.atlas_hits,
+        }
+
+
+asset_cache = AssetCache()
+
+
+def get_asset(file_path, size):
+    # The returned image is shared between cards, copy it before drawing on it
+    return asset_cache.get(file_path, size)
+
+
+#
+# Text Fitting
+#
+
+TextLayout = namedtuple('TextLayout', ['font', 'text'])
+
+# Advance width of every word measured so far and the height of a line, per (font path, font size)
+_word_widths = {}
+_line_heights = {}
+
+
+def _row_width(font, row):
+    left, _, right, _ = font.getbbox(row)
+    return right - left
+
+
+def _line_spacing(font, spacing):
+    key = (font.path, font.size)
+    if key not in _line_heights:
+        _line_heights[key] = font.getbbox('A')[3]
+    return _line_heights[key] + spacing
+
+
+def _estimated_row_width(font, row):
+    widths = _word_widths.setdefault((font.path, font.size), {})
+    words = row.split(' ')
+    total = 0
     for word in words:
-        if not multiline_text_list or d.textsize(f'{multiline_text_list[-1]} {word}', font)[0] >= xy(*boundaries)[0]:
-            multiline_text_list.append('')
-        multiline_text_list[-1] += word + ' '
+        width = widths.get(word)
+        if width is None:
+            width = widths[word] = font.getlength(word)
+        total += width
+    return total + (len(words) - 1) * font.getlength(' ')
 
-    multiline_text = '\n'.join(multiline_text_list).strip()
-    if d.textsize(multiline_text, font)[0] >= xy(*boundaries)[0] or d.textsize(multiline_text, font)[1] >= xy(*boundaries)[1]:
-        smaller_font = ImageFont.truetype(font.path, size=font.size - 2)
-        wrapped_text(d, text, smaller_font, boundaries, alignment, *args, **kwargs)
 
+def _is_too_wide(font, text, max_width):
+    # Summed word advances are only off from the rendered width by glyph bearings, a few pixels at most,
+    # so only rows ending this close to the boundary need measuring for real
+    tolerance = font.size // 4
+    for row in text.split('\n'):
+        width = _estimated_row_width(font, row)
+        if abs(width - max_width) <= tolerance:
+            width = _row_width(font, row)
+        if width >= max_width:
+            return True
+    return False
+
+
+def _wrap_words(words, font, max_width):
+    lines = []
+    for word in words:
+        # The line already ends in a space, so this is the same double spaced string the old wrapping measured
+        if not lines or _is_too_wide(font, f'{lines[-1]} {word}', max_width):
+            lines.append('')
+        lines[-1] += word + ' '
+    return '\n'.join(lines).strip()
+
+
+def _fit_at_size(words, font, size, boundaries):
+    # Text is always measured at full scale and only drawn at the render scale, so a draft wraps and shrinks its
+    # text at the same words and sizes as the full size card, rather than wherever hinting at a few pixels puts it
+    max_width, max_height = xy(*boundaries, scale=1)
+    sized_font = fonts.get(font.path, size, scale=1)
+    multiline_text = _wrap_words(words, sized_font, max_width)
+    layout = TextLayout(fonts.get(font.path, size), multiline_text)
+
+    rows = multiline_text.count('\n') + 1
+    if rows == 1:
+        height = sized_font.getbbox(multiline_text)[3]
     else:
-        d.multiline_text(text=multiline_text, font=font, align=alignment, *args, **kwargs)
+        height = rows * _line_spacing(sized_font, 4) - 4
+    return layout, height < max_height and not _is_too_wide(sized_font, multiline_text, max_width)
 
-    _offset = d.multiline_textsize(multiline_text)
-    return _offset
\ No newline at end of file
+
+def fit_text(text, font, boundaries):
+    words = text.split(' ')
+    layout, fits = _fit_at_size(words, font, font.full_size, boundaries)
+    if fits:
+        return layout
+
+    # Binary search the same 2 point steps the text used to shrink through one at a time
+    sizes = range(font.full_size - 2, 0, -2)
+    low, high = 0, len(sizes) - 1
+    best = None
+    while low <= high:
+        middle = (low + high) // 2
+        candidate, fits = _fit_at_size(words, font, sizes[middle], boundaries)
+        if fits:
+            best = candidate
+            high = middle - 1
+        else:
+            low = middle + 1
+            layout = candidate
+    return best or layout
+
+
+def wrapped_text(d, text, font, boundaries, alignment, *args, **kwargs):
+    layout = fit_text(text, font, boundaries)
+    d.multiline_text(text=layout.text, font=layout.font, align=alignment, spacing=LINE_SPACING, *args, **kwargs)
+    return layout